@@ -19,6 +19,11 @@ from .make_panpipe import Make_panpipe
 from .make_reed import Make_reed, Make_reed_shaper
 
 from .tune import Tune
+from .sweep import Sweep
+from .compare import Compare_optimizers
+from .tolerance import Tolerance
+from .telemetry import Telemetry_summary
+from .bench import Bench
 
 from .all import All
 
@@ -60,6 +65,11 @@ def main():
             
             'Utilities',
             Tune,
+            Sweep,
+            Compare_optimizers,
+            Tolerance,
+            Telemetry_summary,
+            Bench,
             
             'Everything',        
             All,
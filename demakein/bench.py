@@ -0,0 +1,186 @@
+"""
+
+Benchmarks of acoustic evaluation and design convergence.
+
+For each designer, starting from its initial state vector:
+- the cost of unpacking a state vector into an instrument,
+- the throughput of resonance_phase and true_wavelength_near,
+  and of the batched true_wavelengths_near used in scoring,
+- scores per second,
+- how many evaluations optimize.improve needs to reach a target score,
+  with a fixed random number seed, counting checks of the constraints 
+  as well as scores (see compare.py).
+
+Results are saved as JSON, and can be compared with an earlier run.
+
+"""
+
+import json, random, sys, time, platform
+
+import demakein
+from . import config, legion, design, compare, sweep
+
+
+BENCH_DESIGNERS = [
+    'design-folk-flute',
+    'design-pflute',
+    'design-shawm',
+    'design-folk-whistle',
+    'design-recorder',
+    ]
+
+# For each measurement, whether bigger is better
+METRICS = [
+    ('unpack_us', False),
+    ('resonance_phase_per_s', True),
+    ('true_wavelength_near_per_s', True),
+    ('true_wavelengths_near_per_s', True),
+    ('score_per_s', True),
+    ('evals_to_target', False),
+    ('best_score', False),
+    ]
+
+
+def _rate(func, items, seconds):
+    """ Calls of func per second, over items repeatedly, for about seconds. """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for item in items:
+            func(item)
+        count += len(items)
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def _timings(designer, seconds, seed):
+    rng = random.Random(seed)
+    state_vec = designer.initial_state_vec
+
+    # Slightly different state vectors, as during optimization,
+    # so remembered profiles are not simply reused
+    vecs = [
+        [ item * (1.0 + rng.gauss(0.0, 1e-4)) for item in state_vec ]
+        for i in range(200)
+        ]
+
+    inst = designer.patch_instrument(designer.unpack(state_vec))
+    inst.prepare()
+    inst.prepare_phase()
+    inst.prepare_phase_array()
+    ws = [ design.wavelength(item[0], designer.transpose) for item in designer.fingerings ]
+    fingerses = [ item[1] for item in designer.fingerings ]
+    probes = list(zip(ws, fingerses))
+
+    return dict(
+        unpack_us = 1e6 / _rate(designer.unpack, vecs, seconds),
+        resonance_phase_per_s = _rate(
+            lambda item: inst.resonance_phase(*item), probes, seconds),
+        true_wavelength_near_per_s = _rate(
+            lambda item: inst.true_wavelength_near(*item), probes, seconds),
+        true_wavelengths_near_per_s = len(probes) * _rate(
+            lambda item: inst.true_wavelengths_near(ws, fingerses), [ None ], seconds),
+        score_per_s = _rate(designer._scorer, vecs, seconds),
+        )
+
+
+def _converge(designer, target, max_evals, seed):
+    random.seed(seed)
+    reached, best, count, n_scores, seconds = compare._race(designer, 'improve', target, max_evals)
+    return dict(evals_to_target = reached, best_score = best, evals = count)
+
+
+@config.help("""\
+Benchmark acoustic evaluation and optimization on stock designers.
+""","""\
+Measures the cost of unpack, the throughput of resonance_phase, \
+true_wavelength_near and scoring, and the number of evaluations \
+optimize.improve needs to reach --target, with a fixed --seed. \
+Timings are made one at a time, optimizations are spread over --make-cores. \
+Results are written to bench.json and bench.txt. \
+Give --baseline as the bench.json of an earlier run to compare with it.
+""")
+@config.Float_flag('seconds', 'Time to spend on each timing.')
+@config.Float_flag('target', 'Score for optimize.improve to reach.')
+@config.Int_flag('max_evals', 'Maximum number of evaluations in each optimization.')
+@config.Int_flag('seed', 'Random number seed.')
+@config.Bool_flag('converge', 'Also benchmark optimization.')
+@config.String_flag('baseline', 'bench.json from an earlier run to compare with.')
+@config.Main_section('designers', 'Designers to use, eg design-folk-flute.')
+class Bench(config.Action_with_output_dir):
+    seconds = 1.0
+    target = 5.0
+    max_evals = 20000
+    seed = 1
+    converge = True
+    baseline = None
+    designers = [ ]
+
+    def run(self):
+        names = self.designers or BENCH_DESIGNERS
+        designers = [ sweep.find_designer(name)() for name in names ]
+
+        results = { }
+        for name, designer in zip(names, designers):
+            print('Timing', name)
+            results[name] = _timings(designer, self.seconds, self.seed)
+
+        if self.converge:
+            with legion.Stage() as stage:
+                futures = [
+                    stage.process(_converge, designer, self.target, self.max_evals, self.seed)
+                    for designer in designers
+                    ]
+            for name, future in zip(names, futures):
+                results[name].update(future())
+
+        output = dict(
+            version = demakein.VERSION,
+            python = sys.version.split()[0],
+            machine = platform.machine(),
+            seconds = self.seconds,
+            target = self.target,
+            max_evals = self.max_evals,
+            seed = self.seed,
+            results = results,
+            )
+        with open(self.get_workspace()/'bench.json', 'w') as f:
+            json.dump(output, f, indent=2)
+
+        baseline = None
+        if self.baseline:
+            with open(self.baseline) as f:
+                baseline = json.load(f)['results']
+
+        lines = [ '%-22s %-28s %14s %14s %9s' % ('designer', 'measurement', 'value', 'baseline', 'change') ]
+        for name in names:
+            for metric, bigger_is_better in METRICS:
+                if metric not in results[name]:
+                    continue
+                value = results[name][metric]
+                old = None
+                if baseline is not None:
+                    old = baseline.get(name, { }).get(metric)
+
+                change = ''
+                if value is not None and old:
+                    ratio = value / old
+                    # Positive is better
+                    change = '%+8.1f%%' % ((ratio - 1.0 if bigger_is_better else 1.0/ratio - 1.0) * 100.0)
+
+                lines.append('%-22s %-28s %14s %14s %9s' % (
+                    name, metric,
+                    '%.6g' % value if value is not None else '-',
+                    '%.6g' % old if old is not None else '-',
+                    change,
+                    ))
+        if baseline is not None:
+            lines.append('(change: positive is better)')
+
+        with open(self.get_workspace()/'bench.txt', 'w') as f:
+            for line in lines:
+                print(line, file=f)
+        print()
+        for line in lines:
+            print(line)
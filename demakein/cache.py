@@ -0,0 +1,95 @@
+"""
+
+Cache of optimized designs, shared between output directories.
+
+Designs are stored under a hash of the designer class, 
+the parameters that affect its output, 
+and the source code that could affect the result,
+including that of designer classes defined outside demakein.
+The cache is in $DEMAKEIN_CACHE, or ~/.cache/demakein
+
+"""
+
+import os, sys, pickle, hashlib, inspect
+
+
+def cache_dir():
+    return os.environ.get('DEMAKEIN_CACHE') or \
+           os.path.join(os.path.expanduser('~'), '.cache', 'demakein')
+
+
+_STDLIB = set(getattr(sys, 'stdlib_module_names', ())) | set([ 'builtins' ])
+
+
+def _class_source(cls):
+    """ Source of a class, or if it is not available 
+        the values of its attributes other than methods. """
+    try:
+        return inspect.getsource(cls)
+    except (OSError, TypeError):
+        return repr(sorted(
+            (key, repr(value)) for key, value in vars(cls).items()
+            if not key.startswith('__') and not callable(value)
+            ))
+
+
+def _source_hash(designer):
+    from . import config, design, optimize, profile, resonance
+    
+    modules = set([ config, design, optimize, profile, resonance ])
+    classes = [ ]
+    for item in type(designer).__mro__:
+        module = sys.modules.get(item.__module__)
+        if module is not None and module.__name__.startswith(__package__+'.'):
+            modules.add(module)
+        elif item.__module__.split('.')[0] not in _STDLIB:
+            # Eg a designer subclass in a user's script
+            classes.append(item)
+    
+    h = hashlib.sha1()
+    for module in sorted(modules, key=lambda item: item.__name__):
+        with open(inspect.getsourcefile(module),'rb') as f:
+            h.update(f.read())
+    for item in classes:
+        h.update(_class_source(item).encode())
+    return h.hexdigest()
+
+
+# initial_from is represented by the starting state vector instead
+_IGNORE = ('output_dir', 'initial_from')
+
+def design_key(designer, start_vec):
+    """ Stable hash identifying the result of optimizing 
+        designer from start_vec. """
+    items = [ type(designer).__module__, type(designer).__name__, _source_hash(designer), list(start_vec) ]
+    for parameter in designer.parameters:
+        if parameter.affects_output and parameter.name not in _IGNORE:
+            items.append((parameter.name, parameter.get(designer)))
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+
+def _filename(designer, start_vec):
+    return os.path.join(cache_dir(), design_key(designer, start_vec) + '.pickle')
+
+
+def get(designer, start_vec):
+    """ Returns a dict with state_vec and score, or None. """
+    filename = _filename(designer, start_vec)
+    if not os.path.exists(filename):
+        return None
+    with open(filename,'rb') as f:
+        return pickle.load(f)
+
+
+def put(designer, start_vec, state_vec, score):
+    filename = _filename(designer, start_vec)
+    if not os.path.exists(cache_dir()):
+        os.makedirs(cache_dir())
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename,'wb') as f:
+        pickle.dump(dict(
+            designer = type(designer).__name__,
+            state_vec = state_vec,
+            score = score,
+            ), f)
+    os.replace(temp_filename, filename)
@@ -0,0 +1,126 @@
+"""
+
+Compare optimization engines on the stock designers.
+
+Each engine is raced from each designer's initial state vector,
+counting evaluations until the score reaches a target.
+Checks of the constraints count as evaluations as well as scores, 
+as both unpack the instrument.
+
+"""
+
+import time
+
+from . import config, legion, optimize, sweep
+
+
+class _Finished(Exception): 
+    pass
+
+
+def _race(designer, engine, target, max_evals):
+    """ Optimize with engine until the score reaches target, 
+        or max_evals evaluations have been made, 
+        counting both checks of the constraints and scores.
+        
+        Returns (evaluations to reach target or None, best score or None, 
+                 evaluations, of which scores, time). 
+    """
+    count = [ 0 ]
+    n_scores = [ 0 ]
+    best = [ None ]
+    reached = [ None ]
+    def constrainer(state_vec):
+        if count[0] >= max_evals:
+            raise _Finished()
+        count[0] += 1
+        return designer._constrainer(state_vec)
+    
+    def scorer(state_vec):
+        if count[0] >= max_evals:
+            raise _Finished()
+        score = designer._scorer(state_vec)
+        count[0] += 1
+        n_scores[0] += 1
+        if best[0] is None or score < best[0]:
+            best[0] = score
+        if score <= target:
+            reached[0] = count[0]
+            raise _Finished()
+        return score
+    
+    start = time.time()
+    try:
+        optimize.engines[engine](
+            designer.shell_name() + ' ' + engine, 
+            constrainer, scorer, designer.initial_state_vec)
+    except _Finished:
+        pass
+    return reached[0], best[0], count[0], n_scores[0], time.time() - start
+
+
+# Designers known to work, as in test.sh
+STOCK_DESIGNERS = [
+    'design-folk-flute',
+    'design-pflute',
+    'design-folk-whistle',
+    'design-dorian-whistle',
+    'design-recorder',
+    'design-three-hole-whistle',
+    'design-shawm',
+    'design-folk-shawm',
+    'design-reed-drone',
+    ]
+
+
+@config.help("""\
+Compare how quickly each optimization engine designs each instrument.
+""","""\
+Each engine optimizes each designer's default instrument until the score \
+reaches --target or --max-evals evaluations have been made. \
+Checks of the constraints count as evaluations as well as scores. \
+If no designers are given, all the stock designers are used. \
+A table of evaluations and time to reach the target is written to summary.txt.
+""")
+@config.String_flag('engines', 'Comma separated list of engines to compare.')
+@config.Float_flag('target', 'Score to reach.')
+@config.Int_flag('max_evals', 'Maximum number of evaluations in each run.')
+@config.Main_section('designers', 'Designers to use, eg design-folk-flute.')
+class Compare_optimizers(config.Action_with_output_dir):
+    engines = 'improve,cmaes'
+    target = 5.0
+    max_evals = 100000
+    designers = [ ]
+    
+    def run(self):
+        engines = [ item.strip() for item in self.engines.split(',') ]
+        for engine in engines:
+            if engine not in optimize.engines:
+                raise config.Error('Unknown optimizer: ' + engine)
+        designers = self.designers or STOCK_DESIGNERS
+        
+        futures = [ ]
+        with legion.Stage() as stage:
+            for name in designers:
+                designer = sweep.find_designer(name)()
+                for engine in engines:
+                    futures.append((name, engine, 
+                        stage.process(_race, designer, engine, self.target, self.max_evals)))
+        
+        lines = [ '%-30s %-10s %12s %12s %12s %12s %10s' % (
+            'designer', 'engine', 'to target', 'best score', 'evaluations', 'scores', 'time (s)') ]
+        for name, engine, future in futures:
+            reached, best, count, n_scores, seconds = future()
+            lines.append('%-30s %-10s %12s %12s %12d %12d %10.1f' % (
+                name, engine, 
+                reached if reached is not None else '-', 
+                '%.5f' % best if best is not None else '-', 
+                count, n_scores, seconds,
+                ))
+        
+        with open(self.get_workspace()/'summary.txt', 'w') as f:
+            for line in lines:
+                print(line, file=f)
+        print()
+        for line in lines:
+            print(line)
@@ -14,9 +14,9 @@ Fingerholes are enumerated from bottom (end-most) to top.
 
 """
 
-import math, os, pickle, sys, random, collections
+import math, os, pickle, sys, random, collections, functools, copy, multiprocessing
 
-from . import profile, svg
+from . import profile, svg, resonance, telemetry
 
 from . import config
 
@@ -141,6 +141,18 @@ def junction3_reply_phase(a0,a1,a2, p1,p2):
     shift2 = math.floor(p2+0.5)
     return untanner(a1/a0*tanner(p1-shift1) + a2/a0*tanner(p2-shift2)) + shift1 + shift2
 
+def cone_reply_phase(phase_end, length_on_wavelength, offset_low, offset_high):
+    """ pipe_reply_phase for a conical pipe, using spherical waves.
+        offset_low and offset_high are 1/(k*r) at the bottom and top 
+        of the pipe, where r is the distance from the apex of the cone 
+        (negative if the apex is above).
+    """
+    shift = math.floor(phase_end+0.5)
+    phase = untanner(tanner(phase_end-shift) - offset_low) + shift
+    phase += length_on_wavelength * 2.0
+    shift = math.floor(phase+0.5)
+    return untanner(tanner(phase-shift) + offset_high) + shift
+
 
 
 
@@ -187,6 +199,8 @@ class Instrument:
             hole_diameters - hole diameters
             closed_top - is the mouthpiece closed (eg reed) or open (eg ney)
             cone_step - inner profile step size for conical segments of inner profile
+            conical - (optional) in the phase version, model conical segments of 
+                      the inner profile as cones rather than as steps of size cone_step
         
         Old version, call:
             .prepare()
@@ -197,8 +211,15 @@ class Instrument:
             .prepare_phase()
                - prepare to handle queries
             .resonance_phase(wavelength, fingers)
+        
+        Array version of the new version, call:
+            .prepare_phase_array()
+               - prepare to handle queries
+            .resonance_phase_array(wavelengths, fingers)
     """
     
+    conical = False
+    
     def prepare(self):
         self.stepped_inner = self.inner.as_stepped(self.cone_step)
     
@@ -316,46 +337,94 @@ class Instrument:
 
     # phase version
     # =============
-    def prepare_phase(self):
-        self.stepped_inner = self.inner.as_stepped(self.cone_step)
+    def stepped_bore(self):
+        """ Stepped inner profile, starting position and diameter,
+            and a list of (position, area, area1, diameter) for each step.
+
+            This only depends on the bore, so it is shared between
+            instruments that differ only in their holes.
+        """
+        return _stepped_bore(
+            (tuple(self.inner.pos), tuple(self.inner.low), tuple(self.inner.high)),
+            self.length, self.cone_step, self.outer(0.0,True))
+
+    def conical_bore(self):
+        """ Like stepped_bore, but with the unstepped inner profile,
+            and a step at each of its kinks.
+            
+            The taper of a conical segment is the rate of change of diameter 
+            over the diameter, ie one over the distance to the apex.
+        """
+        inner = self.inner
+        position = -end_flange_length_correction(self.outer(0.0,True),inner(0.0,True))
+        steps = [ ]
+        for i, pos in enumerate(inner.pos):
+            if 0.0 < pos < self.length:
+                steps.append((pos, circle_area(inner.high[i]), circle_area(inner.low[i]), inner.high[i]))
+        return position, inner(0.0,True), steps
+    
+    def taper(self, low, high):
+        """ Taper of the inner profile at the bottom and top of the pipe from low to high,
+            or None if it is cylindrical. """
+        if not self.conical or high <= low:
+            return None
+        d_low = self.inner(low, True)
+        d_high = self.inner(high, False)
+        if d_low == d_high:
+            return None
+        slope = (d_high-d_low) / (high-low)
+        return slope/d_low, slope/d_high
+    
+    def phase_elements(self, stepped=False):
+        """ Walk the stepped bore from the bottom up.
+        
+            Yields (pipe length, action, junction, taper) for each bore step, 
+            hole, and the top end. junction is (area, area1) for a step,
+            (area, hole_area, open_length, closed_length, index) for a hole,
+            and None for the end. taper is None for a cylindrical pipe, 
+            or for a conical pipe the taper at the bottom and top of the pipe 
+            (see conical_bore).
+            
+            If stepped is true, the bore is stepped even if .conical is set.
+        """
+        conical = self.conical and not stepped
+        if conical:
+            self.stepped_inner = self.inner
+            position, diameter, steps = self.conical_bore()
+            
+            # Flange correction, below the bottom of the bore
+            area = circle_area(diameter)
+            yield -position, 'step', (area, area), None
+            position = 0.0
+        else:
+            stepped_inner, position, diameter, steps = self.stepped_bore()
+            if not self.conical:
+                self.stepped_inner = stepped_inner
     
         events = [
             (self.length, 'end', None)
         ]
         
-        for i, pos in enumerate(self.stepped_inner.pos):
-            if 0.0 < pos < self.length:
-                events.append((pos, 'step', i))
+        for step in steps:
+            events.append((step[0], 'step', step))
         
         for i, pos in enumerate(self.inner_hole_positions):
             events.append((pos,'hole', i))
         
         events.sort(key=lambda item: item[0])
     
-        self.actions_phase = [ ]
-        
-        position = -end_flange_length_correction(self.outer(0.0,True),self.stepped_inner(0.0,True))
-        diameter = self.stepped_inner(0.0, True)
         for pos, action, index in events:
             length = pos-position
-            
-            def func(phase_end, wavelength, fingers, length=length):
-                return pipe_reply_phase(phase_end, length/wavelength)
-            self.actions_phase.append(func)
-            
+            taper = self.taper(position, pos) if conical else None
             position = pos
             
             if action == 'step':
-                assert diameter == self.stepped_inner.low[index]
-                area1 = circle_area(diameter)
-                diameter = self.stepped_inner.high[index]
-                area = circle_area(diameter)
-                
-                def func(phase, wavelength, fingers, area=area, area1=area1):
-                    return junction2_reply_phase(area, area1, phase)
-                self.actions_phase.append(func)
+                _, area, area1, diameter = index
+                yield length, action, (area, area1), taper
                 
             elif action == 'hole':
+                if conical:
+                    diameter = self.inner(pos)
                 area = circle_area(diameter)
                 hole_diameter = self.hole_diameters[index]
                 hole_area = circle_area(hole_diameter)
@@ -367,6 +436,33 @@ class Instrument:
                 
                 open_length = true_length + hole_length_correction(hole_diameter, diameter, False) 
                 closed_length = true_length + hole_length_correction(hole_diameter, diameter, True)
+                yield length, action, (area, hole_area, open_length, closed_length, index), taper
+            
+            else:
+                yield length, action, None, taper
+
+    def prepare_phase(self):
+        self.actions_phase = [ ]
+        
+        for length, action, junction, taper in self.phase_elements():
+            if taper is None:
+                def func(phase_end, wavelength, fingers, length=length):
+                    return pipe_reply_phase(phase_end, length/wavelength)
+            else:
+                def func(phase_end, wavelength, fingers, length=length, taper=taper):
+                    scale = wavelength / (2.0*math.pi)
+                    return cone_reply_phase(phase_end, length/wavelength, taper[0]*scale, taper[1]*scale)
+            self.actions_phase.append(func)
+            
+            if action == 'step':
+                area, area1 = junction
+                
+                def func(phase, wavelength, fingers, area=area, area1=area1):
+                    return junction2_reply_phase(area, area1, phase)
+                self.actions_phase.append(func)
+                
+            elif action == 'hole':
+                area, hole_area, open_length, closed_length, index = junction
 
                 def func(phase, wavelength, fingers,
                          area=area,hole_area=hole_area,
@@ -391,6 +487,40 @@ class Instrument:
         
         return phase
 
+
+    # array version
+    # =============
+    def prepare_phase_array(self):
+        self.phase_chain = resonance.Phase_chain(self)
+        self.emission_chain = None
+    
+    def resonance_phase_array(self, w, fingers):
+        """ resonance_phase for an array of wavelengths w. 
+            The first dimension of w enumerates fingerings,
+            one row of fingers for each. """
+        return self.phase_chain.phase(w, fingers)
+
+    def true_wavelengths_near(self, ws, fingerses, ns=None, step_cents=1.0):
+        """ true_wavelength_near or true_nth_wavelength_near 
+            for a list of fingerings, all at once. 
+            
+            ns gives, for each fingering, None or which resonance to find.
+            """
+        return self.phase_chain.true_wavelengths_near(ws, fingerses, ns, step_cents=step_cents)
+    
+    def emissions(self, ws, fingerses):
+        """ The emission from resonance_score(w, fingers, True) 
+            for a list of fingerings, all at once, 
+            without needing .prepare(). 
+            
+            There are no cones in the complex model, so if .conical is set 
+            emission comes from the stepped bore, as in .prepare(). """
+        if not self.conical:
+            return self.phase_chain.emission(ws, fingerses)
+        if self.emission_chain is None:
+            self.emission_chain = resonance.Phase_chain(self, stepped=True)
+        return self.emission_chain.emission(ws, fingerses)
+
         
     def true_wavelength_near(self, w, fingers, step_cents = 1.0, step_increase = 1.05, max_steps = 100):
         #def scorer(probe):
@@ -505,6 +635,111 @@ class Instrument:
         
 
 
+@functools.lru_cache(maxsize=64)
+def _stepped_bore(inner, length, cone_step, outer_diameter):
+    """ Instrument.stepped_bore, remembering recent bores. """
+    stepped_inner = profile.Profile(*[ list(item) for item in inner ]).as_stepped(cone_step)
+    
+    position = -end_flange_length_correction(outer_diameter,stepped_inner(0.0,True))
+    diameter = stepped_inner(0.0, True)
+    steps = [ ]
+    for i, pos in enumerate(stepped_inner.pos):
+        if 0.0 < pos < length:
+            assert diameter == stepped_inner.low[i]
+            area1 = circle_area(diameter)
+            diameter = stepped_inner.high[i]
+            area = circle_area(diameter)
+            steps.append((pos, area, area1, diameter))
+    
+    return stepped_inner, position, stepped_inner(0.0, True), steps
+
+
+@functools.lru_cache(maxsize=64)
+def _curved_profile(pos, low, high, low_angle, high_angle, quality=512):
+    """ profile.curved_profile, remembering recent profiles. 
+        Arguments must be tuples. """
+    return profile.curved_profile(list(pos), list(low), list(high), list(low_angle), list(high_angle), quality)
+
+
+REPAIR_SLACK = 1e-9
+
+def _separate(positions, i, low, high, move_low=True, move_high=True):
+    """ Move positions[i] and positions[i+1] apart or together 
+        so that their separation is between low and high, 
+        for Instrument_designer.repair. Returns whether they were moved. """
+    sep = positions[i+1] - positions[i]
+    if sep < low:
+        target = low + REPAIR_SLACK
+    elif sep > high:
+        target = high - REPAIR_SLACK
+    else:
+        return False
+    if high-low < 2*REPAIR_SLACK:
+        target = 0.5*(low+high)
+    
+    change = target - sep
+    if move_low and move_high:
+        positions[i] -= change*0.5
+        positions[i+1] += change*0.5
+    elif move_high:
+        positions[i+1] += change
+    elif move_low:
+        positions[i] -= change
+    else:
+        return False
+    return True
+
+
+class Snapshot_writer:
+    """ Monitor for optimization that saves snapshots of a design 
+        in the background. 
+        
+        Each snapshot is written by its own process, which has its own 
+        copy of the state, so optimization carries on meanwhile. 
+        If the previous snapshot is still being written, 
+        the request is kept as pending, replacing any older one. 
+        The newest request is written by a later call once the 
+        previous snapshot is done, or else by .close().
+        
+        Call .close() before saving the final design, 
+        in every process with a copy of the writer (see optimize._island).
+    """
+    def __init__(self, designer):
+        self.designer = designer
+        self.process = None
+        self.pending = None
+    
+    def __getstate__(self):
+        # A copy sent to another process starts its own writer
+        return dict(designer=self.designer, process=None, pending=None)
+    
+    def _start(self, args):
+        self.process = multiprocessing.Process(target=self.designer._save, args=args)
+        self.process.start()
+    
+    def __call__(self, state_vec, other_vecs=[]):
+        args = (list(state_vec), list(other_vecs))
+        if self.process is not None:
+            if self.process.is_alive():
+                self.pending = args
+                return
+            self.process.join()
+        self.pending = None
+        self._start(args)
+    
+    def close(self):
+        """ Wait for the snapshot being written, if any, 
+            then write and wait for the pending one. """
+        if self.process is not None:
+            self.process.join()
+            self.process = None
+        if self.pending is not None:
+            self._start(self.pending)
+            self.pending = None
+            self.process.join()
+            self.process = None
+
+
 def low_high(vec):
     low = [ ]
     high = [ ]
@@ -555,13 +790,74 @@ def power_scaler(power, value):
     'to try to make instrument louder, '
     'possibly sacrificing being-in-tuneness.'
     )
+@config.Bool_flag('conical',
+    'Model conical parts of the bore as cones, '
+    'rather than as a staircase of cylinders.'
+    )
+@config.Bool_flag('multi_fidelity',
+    'Optimize with coarser acoustic calculations at first, '
+    'switching to full accuracy as the design settles.'
+    )
+@config.String_flag("optimizer",
+    "Optimization engine, improve or cmaes."
+    )
+@config.Bool_flag("surrogate",
+    "Skip scoring candidate designs that a model fitted to "
+    "already scored designs confidently predicts will be rejected."
+    )
+@config.Bool_flag("repair_candidates",
+    "Adjust candidate designs that do not satisfy constraints, "
+    "such as hole spacing, rather than discarding them."
+    )
+@config.Int_flag("islands",
+    "Number of separate optimizations to run in parallel processes, "
+    "swapping their best designs from time to time."
+    )
+@config.Float_flag("max_seconds",
+    "Stop optimizing after this many seconds, keeping the best design so far."
+    )
+@config.Int_flag("max_evals",
+    "Stop optimizing after this many evaluations of candidate designs, "
+    "counting those rejected by the constraints, "
+    "keeping the best design so far."
+    )
+@config.Float_flag("target_score",
+    "Stop optimizing once a design scores this or better."
+    )
+@config.Bool_flag("telemetry",
+    "Record optimization progress and timings in telemetry.jsonl "
+    "in the output directory. See telemetry-summary.",
+    affects_output=False
+    )
 @config.Int_flag("workers",
-    "Number of worker processes during optimization."
+    "Number of worker processes during optimization.",
+    affects_output=False
+    )
+@config.String_flag("initial_from",
+    "Start optimizing from the design in this output directory, "
+    "for example a different size of the same instrument."
+    )
+@config.Bool_flag("cache",
+    "Reuse an identical earlier design from the shared cache of designs "
+    "($DEMAKEIN_CACHE, or ~/.cache/demakein), "
+    "and add this design to it.",
+    affects_output=False
+    )
+@config.Bool_flag("resume",
+    "Continue an interrupted optimization "
+    "from the checkpoint in the output directory.",
+    affects_output=False
+    )
+@config.Int_flag("batch",
+    "Number of candidates to make and score together "
+    "in each round of optimization."
     )
 class Instrument_designer(config.Action_with_output_dir):
     instrument_class = Instrument
 
     cone_step = 0.125  #diameter step size when approximating cones
+    curve_quality = 512  #steps per turn of curved parts of profiles
+    probe_cents = 1.0  #first probe step when looking for resonances
 
     closed_top = False
 
@@ -569,8 +865,41 @@ class Instrument_designer(config.Action_with_output_dir):
     
     tweak_emission = 0.0
     
+    conical = False
+    
+    multi_fidelity = False
+    
+    # Stages of optimization before full accuracy, with --multi-fidelity:
+    # (xtol, cone_step, curve_quality, probe_cents)
+    fidelity_schedule = [
+        (1e-2, 1.0, 128, 4.0),
+        (1e-3, 0.5, 256, 2.0),
+    ]
+    
+    optimizer = 'improve'
+    
+    surrogate = False
+    
+    repair_candidates = False
+    
+    islands = 1
+    
+    max_seconds = None
+    max_evals = None
+    target_score = None
+    
+    telemetry = True
+    
     workers = 1
     
+    batch = 1
+    
+    resume = False
+    
+    initial_from = None
+    
+    cache = False
+    
     initial_length = None
     max_length = None
 
@@ -723,25 +1052,44 @@ class Instrument_designer(config.Action_with_output_dir):
         p += len(self.outer_diameters)-2
         assert p == len(state_vec)
         
-        inst.inner = profile.curved_profile(
-            [0.0]+inner_kinks+[inst.length],
-            inner_low,
-            inner_high,
-            inner_angle_low,
-            inner_angle_high,
-        )
-        inst.outer = profile.curved_profile(
-            [0.0]+outer_kinks+[inst.length],
-            outer_low,
-            outer_high,
-            outer_angle_low,
-            outer_angle_high,
-        )
+        # Profiles are remembered, so if only the holes have changed
+        # the bore isn't recalculated
+        with telemetry.phase('curved_profile'):
+            inst.inner = _curved_profile(
+                tuple([0.0]+inner_kinks+[inst.length]),
+                tuple(inner_low),
+                tuple(inner_high),
+                tuple(inner_angle_low),
+                tuple(inner_angle_high),
+                self.curve_quality,
+            )
+            inst.outer = _curved_profile(
+                tuple([0.0]+outer_kinks+[inst.length]),
+                tuple(outer_low),
+                tuple(outer_high),
+                tuple(outer_angle_low),
+                tuple(outer_angle_high),
+                self.curve_quality,
+            )
         
         if self.outer_add:
             inst.outer = inst.outer + inst.inner
 
         inst.hole_angles = self.hole_angles        
+        self._hole_geometry(inst)
+        
+        inst.inner_kinks = inner_kinks
+        inst.outer_kinks = outer_kinks
+        
+        inst.cone_step = self.cone_step
+        inst.conical = self.conical
+        inst.closed_top = self.closed_top
+        return inst
+
+    
+    def _hole_geometry(self, inst):
+        """ Work out where holes meet the bore, and their lengths, 
+            from their positions and angles and the bore and outer profiles. """
         inst.inner_hole_positions = [ None ] * self.n_holes
         inst.hole_lengths = [ None ] * self.n_holes
         for i in range(self.n_holes):
@@ -754,14 +1102,6 @@ class Instrument_designer(config.Action_with_output_dir):
                 math.sqrt(thickness*thickness+shift*shift) 
                 #+ self.hole_extra_height_by_diameter[i] * inst.hole_diameters[i]
             )
-        
-        inst.inner_kinks = inner_kinks
-        inst.outer_kinks = outer_kinks
-        
-        inst.cone_step = self.cone_step
-        inst.closed_top = self.closed_top
-        return inst
-
     
     def constraint_score(self, inst):
         """ Return an amount of constraint dissatisfaction """
@@ -830,6 +1170,89 @@ class Instrument_designer(config.Action_with_output_dir):
         negscore = sum(negscores) if negscores else 0.0
         return negscore
 
+    def repair(self, state_vec):
+        """ Nudge state_vec to satisfy constraint_score, 
+            by clamping values and adjusting separations.
+            
+            Only the constraints of constraint_score here are considered, 
+            so the result should still be checked.
+        """
+        state_vec = list(state_vec)
+        n_holes = self.n_holes
+        
+        state_vec[0] = max(state_vec[0], REPAIR_SLACK)
+        if self.max_length is not None:
+            state_vec[0] = min(state_vec[0], self.max_length / self.initial_length - REPAIR_SLACK)
+        length = state_vec[0] * self.initial_length * self.scale
+        p = 1
+        
+        holes = state_vec[p:p+n_holes]
+        p += n_holes
+        
+        state_vec[p:p+n_holes] = [ min(max(item, 0.0), 1.0-REPAIR_SLACK) for item in state_vec[p:p+n_holes] ]
+        p += n_holes
+        
+        n_inner = len(self.inner_diameters)-2
+        inner = [ 0.0 ] + state_vec[p:p+n_inner] + [ 1.0 ]
+        p += n_inner
+        
+        n_outer = len(self.outer_diameters)-2
+        outer = [ 0.0 ] + state_vec[p:p+n_outer] + [ 1.0 ]
+        
+        hole_limits = [ 
+            ((low or 0.0) / length, (high if high is not None else 1e30) / length)
+            for low, high in zip(self.min_hole_spacing, self.max_hole_spacing) 
+            ]
+        balance = self.balance
+        
+        inner_limits = [ ]
+        for low, high, low_sep, high_sep in zip(
+                self.min_inner_fraction_sep, self.max_inner_fraction_sep,
+                self.min_inner_sep, self.max_inner_sep):
+            if low_sep is not None:
+                low = max(low, low_sep*self.scale/length)
+            if high_sep is not None:
+                high = min(high, high_sep*self.scale/length)
+            inner_limits.append((low, high))
+        
+        outer_limits = list(zip(self.min_outer_fraction_sep, self.max_outer_fraction_sep))
+        
+        for i in range(100):
+            moved = False
+            
+            if n_holes:
+                if holes[0] < self.bottom_clearance_fraction:
+                    holes[0] = self.bottom_clearance_fraction + REPAIR_SLACK
+                    moved = True
+                if holes[-1] > 1.0-self.top_clearance_fraction:
+                    holes[-1] = 1.0-self.top_clearance_fraction - REPAIR_SLACK
+                    moved = True
+            
+            for j, (low, high) in enumerate(hole_limits):
+                moved = _separate(holes, j, low, high) or moved
+            
+            for j, value in enumerate(balance):
+                if value is None: continue
+                middle = 0.5*(holes[j]+holes[j+2])
+                allowed = max(0.0, value*0.5*(holes[j+2]-holes[j]) - REPAIR_SLACK)
+                if abs(holes[j+1]-middle) > allowed:
+                    holes[j+1] = min(max(holes[j+1], middle-allowed), middle+allowed)
+                    moved = True
+            
+            for positions, limits in [ (inner, inner_limits), (outer, outer_limits) ]:
+                for j, (low, high) in enumerate(limits):
+                    moved = _separate(positions, j, low, high, j > 0, j < len(limits)-1) or moved
+            
+            if not moved:
+                break
+        
+        state_vec[1:1+n_holes] = holes
+        p = 1+2*n_holes
+        state_vec[p:p+n_inner] = inner[1:-1]
+        p += n_inner
+        state_vec[p:p+n_outer] = outer[1:-1]
+        return state_vec
+
     def patch_instrument(self, inst):
         """ Hook to modify instrument before scoring. """
         return inst
@@ -851,22 +1274,29 @@ class Instrument_designer(config.Action_with_output_dir):
         #emission_score2 = 0.0
         emission_div = 0.0
         
+        with telemetry.phase('prepare_phase'):
+            inst.prepare_phase_array()
+        
+        # Find resonances for all fingerings together
+        with telemetry.phase('root_finding'):
+            w2s = inst.true_wavelengths_near(
+                [ wavelength(item[0], self.transpose) for item in self.fingerings ],
+                [ item[1] for item in self.fingerings ],
+                [ item[2] if len(item) >= 3 else None for item in self.fingerings ],
+                step_cents=self.probe_cents,
+                ).tolist()
+        
         if self.tweak_emission:
-            inst.prepare()
-        inst.prepare_phase()
+            with telemetry.phase('emission'):
+                emissions = inst.emissions(w2s, [ item[1] for item in self.fingerings ])
         
         s = 1200.0/math.log(2)
-        for item in self.fingerings:
+        for i, (item, w2) in enumerate(zip(self.fingerings, w2s)):
             note = item[0]
             fingers = item[1]
             
             w1 = wavelength(note, self.transpose)
             
-            if len(item) < 3:
-                w2 = inst.true_wavelength_near(w1, fingers)
-            else:
-                w2 = inst.true_nth_wavelength_near(w1, fingers, item[2])
-            
             diff = abs(math.log(w1)-math.log(w2))*s
             
             #weight = w1
@@ -892,8 +1322,7 @@ class Instrument_designer(config.Action_with_output_dir):
             if self.tweak_emission:
                 emission_weight = 1.0 #w1
                 emission_div += emission_weight
-                _, emission = inst.resonance_score(w2,fingers,True)
-                rms = self.calc_emission(emission, fingers)
+                rms = self.calc_emission(emissions[i], fingers)
                 #math.sqrt(sum(item*item for item in emission))
                 x = math.log(rms)
                 emission_score += emission_weight * x
@@ -915,7 +1344,31 @@ class Instrument_designer(config.Action_with_output_dir):
         return self.constraint_score(self.unpack(state_vec))
 
     def _scorer(self, state_vec):
-        return self.score(self.unpack(state_vec))
+        if not self.telemetry or self.output_dir is None:
+            return self.score(self.unpack(state_vec))
+        
+        timer = telemetry.timer(os.path.join(self.output_dir, 'telemetry.jsonl'))
+        timer.start()
+        with telemetry.phase('evaluation'):
+            with telemetry.phase('unpack'):
+                inst = self.unpack(state_vec)
+            result = self.score(inst)
+        timer.finish()
+        return result
+    
+    def _schedule(self):
+        """ Coarser scorers for optimize.improve, from fidelity_schedule. """
+        if not self.multi_fidelity:
+            return [ ]
+        
+        result = [ ]
+        for xtol, cone_step, curve_quality, probe_cents in self.fidelity_schedule:
+            coarse = copy.copy(self)
+            coarse.cone_step = cone_step
+            coarse.curve_quality = curve_quality
+            coarse.probe_cents = probe_cents
+            result.append((coarse._scorer, xtol))
+        return result
 
     #def _opt_score(self, state_vec):
     #    inst = self.unpack(state_vec)
@@ -958,15 +1411,18 @@ class Instrument_designer(config.Action_with_output_dir):
         self.state_vec = state_vec
         self.instrument = self.unpack( state_vec )
         
-        with open(os.path.join(self.output_dir, 'data.pickle'), 'wb') as f:
+        # Files are written under a temporary name then renamed, 
+        # so they are never seen half written
+        filename = os.path.join(self.output_dir, 'data.pickle')
+        with open(filename+'.part', 'wb') as f:
             if sys.version_info.major == 3:
                 pickle.dump(self, f, fix_imports=True)
             else:
                 pickle.dump(self, f)
+        os.replace(filename+'.part', filename)
 
         patched_instrument = self.patch_instrument(self.instrument)
         patched_instrument.prepare()
-        patched_instrument.prepare_phase()
         
       #  #any_extra = any( item != 0.0 for item in self.hole_extra_height_by_diameter )
       #  #if any_extra:
@@ -1019,23 +1475,33 @@ class Instrument_designer(config.Action_with_output_dir):
         emit_x = graph_x+220
         text_y = 0
         
+        # Resonance sweeps for all fingerings, as a single array calculation
+        n_probes = 301
+        max_cents = 2400.0
+        width = 200.0
+        step = pow(0.5, max_cents/((n_probes-1)*0.5*1200.0))
+        sweeps = [ ]
         for item in self.fingerings:
+            low = wavelength(item[0], self.transpose) * pow(step, -(n_probes-1)/2.0)
+            sweeps.append([ low * pow(step,i) for i in range(n_probes) ])
+        patched_instrument.prepare_phase_array()
+        sweep_scores = patched_instrument.resonance_phase_array(
+            sweeps, [ item[1] for item in self.fingerings ]).tolist()
+        
+        w2s = patched_instrument.true_wavelengths_near(
+            [ wavelength(item[0], self.transpose) for item in self.fingerings ],
+            [ item[1] for item in self.fingerings ],
+            [ item[2] if len(item) >= 3 else None for item in self.fingerings ],
+            ).tolist()
+        phases = patched_instrument.resonance_phase_array(
+            w2s, [ item[1] for item in self.fingerings ]).tolist()
+        
+        for item, probes, scores, w2, phase in zip(self.fingerings, sweeps, sweep_scores, w2s, phases):
             note = item[0]
-            fingers = item[1]
         
             w1 = wavelength(note, self.transpose)
-            if len(item) < 3:
-                w2 = patched_instrument.true_wavelength_near(w1, fingers)
-            else:
-                w2 = patched_instrument.true_nth_wavelength_near(w1, fingers, item[2])
             cents = int(round( log2(w2/w1) * 1200.0 ))
 
-            n_probes = 301
-            max_cents = 2400.0
-            width = 200.0
-            step = pow(0.5, max_cents/((n_probes-1)*0.5*1200.0))
-            low = w1 * pow(step, -(n_probes-1)/2.0)
-            probes = [ low * pow(step,i) for i in range(n_probes) ]
             #scores = [ patched_instrument.resonance_score(probe, fingers) for probe in probes ]
             #
             #points = [ (graph_x+i*width/n_probes,text_y-score*7.0)
@@ -1045,8 +1511,6 @@ class Instrument_designer(config.Action_with_output_dir):
             #    diagram.line(points[i:i+2], '#000000', 0.2)
 
 
-            scores = [ patched_instrument.resonance_phase(probe, fingers) for probe in probes ]
-
             points = [ (graph_x+i*width/n_probes,text_y-(((score+0.5)%1.0)-0.5)*14.0)
                        for i,score in enumerate(scores) ]
             for i in range(len(probes)-1):
@@ -1069,7 +1533,6 @@ class Instrument_designer(config.Action_with_output_dir):
             #     ', '.join('%.2f' % item for item in emission)
             #     )
             
-            phase = patched_instrument.resonance_phase(w2,fingers)
             diagram.text(emit_x, text_y, "%f" % phase)
             
             #if any_extra:
@@ -1109,12 +1572,14 @@ class Instrument_designer(config.Action_with_output_dir):
             diagram.text(graph_x, text_y+10.0+(len(self.inner_diameters)-i)*10.0, 
                 describe_low_high(item) + 'mm at %.1fmm' % kinks[i]) 
         
-        diagram.save( os.path.join(self.output_dir, 'diagram.svg') )
+        filename = os.path.join(self.output_dir, 'diagram.svg')
+        diagram.save( filename+'.part' )
+        os.replace(filename+'.part', filename)
         
         del self.instrument
 
     def run(self):
-        from . import optimize
+        from . import optimize, cache
 
         assert self.initial_length is not None, 'Initial length required'
         assert len(self.min_hole_diameters) == self.n_holes
@@ -1125,14 +1590,75 @@ class Instrument_designer(config.Action_with_output_dir):
 
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
+        
+        telemetry_file = os.path.join(self.output_dir, 'telemetry.jsonl')
 
         state_vec = self.initial_state_vec
-        state_vec = optimize.improve(
-            self.shell_name(), self._constrainer, self._scorer, state_vec, 
-            workers=self.workers, monitor=self._save)
+        if self.initial_from:
+            initial_vec = load(self.initial_from).state_vec
+            if len(initial_vec) == len(state_vec):
+                state_vec = list(initial_vec)
+            else:
+                print('Design in %s does not match, ignoring it.' % self.initial_from)
+        
+        cached = None
+        if self.cache:
+            start_vec = state_vec
+            cached = cache.get(self, start_vec)
+        
+        # Why optimization stopped, recorded in the output directory
+        stop_reasons = [ ]
+        
+        if cached is not None:
+            print('Using cached design, score %.5f' % cached['score'])
+            stop_reasons.append('Using cached design')
+            state_vec = cached['state_vec']
+        else:
+            if self.optimizer not in optimize.engines:
+                raise config.Error('Unknown optimizer: ' + self.optimizer)
+            
+            # Telemetry of a cached design is left as it was
+            if os.path.exists(telemetry_file) and not self.resume:
+                os.unlink(telemetry_file)
+            
+            options = { }
+            if self.surrogate:
+                if self.optimizer != 'improve':
+                    raise config.Error('--surrogate is only available with --optimizer improve')
+                options['surrogate'] = True
+            if self.repair_candidates:
+                if self.optimizer != 'improve':
+                    raise config.Error('--repair-candidates is only available with --optimizer improve')
+                options['repairer'] = self.repair
+            options['on_stop'] = stop_reasons.append
+            options['max_seconds'] = self.max_seconds
+            options['max_evals'] = self.max_evals
+            options['target'] = self.target_score
+            if self.telemetry and self.optimizer == 'improve':
+                options['telemetry_file'] = telemetry_file
+            engine = optimize.engines[self.optimizer]
+            if self.islands > 1:
+                if self.optimizer != 'improve':
+                    raise config.Error('--islands is only available with --optimizer improve')
+                engine = optimize.islands
+                options['islands'] = self.islands
+            writer = Snapshot_writer(self)
+            state_vec = engine(
+                self.shell_name(), self._constrainer, self._scorer, state_vec, 
+                workers=self.workers, batch=self.batch, monitor=writer,
+                checkpoint=os.path.join(self.output_dir, 'checkpoint.pickle'),
+                resume=self.resume, schedule=self._schedule(), **options)
+            writer.close()
+            
+            # Designs that may have been cut short by a budget are not cached
+            if self.cache and self.max_seconds is None and self.max_evals is None:
+                cache.put(self, start_vec, state_vec, self._scorer(state_vec))
         
         self._save(state_vec)
         
+        with open(os.path.join(self.output_dir, 'stop_reason.txt'), 'w') as f:
+            print(stop_reasons[0], file=f)
+        
         #print(self._opt_score(state_vec))
 
 
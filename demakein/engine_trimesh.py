@@ -24,60 +24,51 @@ class Shape(object):
     
     def cleanup(self):
         """ Merge all vertices within a small tolerance of each other. Cull degenerate triangles. """
-        import scipy.spatial
+        import numpy
+        import scipy.spatial, scipy.sparse, scipy.sparse.csgraph
         import trimesh
         
         tol = 1e-4
         
         verts = self.mesh.vertices
         faces = self.mesh.faces
+        n = len(verts)
         
-        # Union find algorithm
-        parent = list(range(len(verts)))
-        def root(i):
-            root = i
-            while parent[root] != root:
-                root = parent[root]
-            while parent[i] != i:
-                i, parent[i] = parent[i], root
-            return root
+        pairs = scipy.spatial.cKDTree(verts).query_pairs(tol, output_type='ndarray')
         
-        # Merge all points within tol of each other
-        for i,j in scipy.spatial.KDTree(verts).query_pairs(tol):
-            parent[root(j)] = root(i)
+        if len(pairs):
+            # Connected components of the graph of close pairs
+            graph = scipy.sparse.coo_matrix(
+                (numpy.ones(len(pairs),dtype=bool), (pairs[:,0], pairs[:,1])), shape=(n,n))
+            n_groups, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+            
+            # Number groups in order of their first vertex
+            _, first, labels = numpy.unique(labels, return_index=True, return_inverse=True)
+            rank = numpy.empty(n_groups, dtype=int)
+            rank[numpy.argsort(first)] = numpy.arange(n_groups)
+            new_index = rank[labels.reshape(-1)]
+            
+            print("Consolidated", n-n_groups, "points")
+            
+            # Average each group
+            counts = numpy.bincount(new_index, minlength=n_groups)
+            new_verts = numpy.empty((n_groups,3))
+            for i in range(3):
+                new_verts[:,i] = numpy.bincount(new_index, weights=verts[:,i], minlength=n_groups) / counts
+            
+            # Remap indices
+            faces = new_index[faces]
+        else:
+            new_verts = verts
         
-        # Extract result as a list of groups
-        groups = { }
-        for i in range(len(verts)):
-            r = root(i)
-            if r not in groups: groups[r] = [ ]
-            groups[r].append(i)
-        groups = list(groups.values())
+        # Discard degenerate triangles
+        keep = (faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,0] != faces[:,2])
         
-        if len(groups) != len(verts):
-            print("Consolidated", len(verts)-len(groups), "points")
-        
-        # Average each group
-        new_verts = [ verts[group].mean(0) for group in groups ]
-        new_index = { }
-        for i, group in enumerate(groups):
-            for j in group:
-                new_index[j] = i
-        
-        # Remap indices and discard degenerate triangles
-        new_faces = [ ]
-        discards = 0
-        for item in faces:
-            item = [ new_index[i] for i in item ]
-            if len(set(item)) < 3: 
-                discards += 1
-                continue
-            new_faces.append(item)
-        
-        #if discards:
-        #    print("Eliminated", discards, "triangles")
+        if not len(pairs) and keep.all():
+            # Nothing to merge or cull
+            return
         
-        self.mesh = trimesh.Trimesh(vertices=new_verts, faces=new_faces)
+        self.mesh = trimesh.Trimesh(vertices=new_verts, faces=faces[keep])
         self.check()
     
     def triangles(self):
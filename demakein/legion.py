@@ -176,6 +176,8 @@ class My_coordinator:
         self.mail = { }
         self.mail_count = 0
         
+        self.migrants = { }
+        
         self.futures = { }
         self.future_count = 0
         
@@ -199,6 +201,21 @@ class My_coordinator:
     def get_mail(self, number):
         with self.lock:
             return self.mail.pop(number)
+    
+    def post_migrant(self, board, island, value):
+        """ Leave a value from an island on a migration board, 
+            replacing its previous one. """
+        with self.lock:
+            self.migrants.setdefault(board, { })[island] = value
+    
+    def get_migrants(self, board):
+        """ All values on a migration board, by island. """
+        with self.lock:
+            return dict(self.migrants.get(board, { }))
+    
+    def clear_migrants(self, board):
+        with self.lock:
+            self.migrants.pop(board, None)
 
     def new_future(self):
         with self.lock:
@@ -308,6 +325,14 @@ class My_coordinator:
 
     def acquire_core(self):
         self.trade_cores(0,1)
+    
+    def reserve_cores(self, n):
+        """ Take up to n cores that are free, without waiting. 
+            Returns how many were taken. Give them back with change_cores_used. """
+        with self.lock:
+            n = max(0, min(n, self.cores - self.used))
+            self.used += n
+            return n
 
     def set_status(self, identity, value):
         old = self.statuses.get(identity,"")
@@ -1,7 +1,9 @@
 
-import sys, math, random, bisect, multiprocessing, signal, time
+import sys, os, pickle, math, random, bisect, collections, multiprocessing, multiprocessing.connection, signal, time, array, traceback
 
-from . import legion, grace
+import numpy
+
+from . import legion, telemetry
 
 #def status(*items):
 #    """ Display a status string. """
@@ -11,25 +13,365 @@ from . import legion, grace
 #        sys.stderr.flush()
 
 
-def worker(scorer, fut):
+def worker(scorer, connection):
+    """ Worker process loop: receive state vectors as raw doubles,
+        reply with the score, or with nothing if the scorer failed.
+        An empty message means stop. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
     while True:
-        value = legion.coordinator().get_future(fut)
-        if value is None: 
+        try:
+            data = connection.recv_bytes()
+        except EOFError:
+            break
+        if not data:
             break
         
-        item, reply_fut = value
-        result = scorer(item)        
-        fut = legion.coordinator().new_future()
-        legion.coordinator().deliver_future(reply_fut, (result, fut))
+        vec = array.array('d')
+        vec.frombytes(data)
+        try:
+            result = scorer(list(vec))
+        except Exception:
+            traceback.print_exc()
+            connection.send_bytes(b'')
+        else:
+            connection.send_bytes(array.array('d', [ result ]).tobytes())
+    
+    # Timings made by the scorer in this process
+    telemetry.flush()
+
+
+class Worker_pool:
+    """ Long lived worker processes for scoring state vectors.
+    
+        Each worker is handed the scorer once when it starts,
+        after which state vectors and scores go through a pipe.
+        
+        The parent process mostly waits while the workers score, 
+        so one worker runs on its core. Cores for the rest are reserved 
+        from the legion coordinator, so there may be fewer workers 
+        than asked for if other processes are using the cores.
+    """
+    def __init__(self, scorer, workers):
+        self.idle = [ ]
+        self.busy = { }
+        self.processes = [ ]
+        self.process_of = { }
+        self.reserved = legion.coordinator().reserve_cores(workers-1)
+        if self.reserved < workers-1:
+            print(f"Using {1+self.reserved} of {workers} workers, other cores are in use")
+        for i in range(1+self.reserved):
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker, args=(scorer, child_connection), daemon=True)
+            process.start()
+            child_connection.close()
+            self.idle.append(connection)
+            self.processes.append(process)
+            self.process_of[connection] = process
+    
+    def submit(self, vec):
+        """ Start scoring vec on an idle worker. """
+        connection = self.idle.pop(0)
+        connection.send_bytes(array.array('d', vec).tobytes())
+        self.busy[connection] = vec
+    
+    def receive(self):
+        """ Wait for any busy worker to finish. Returns (vec, score). """
+        connection = multiprocessing.connection.wait(list(self.busy))[0]
+        data = connection.recv_bytes()
+        vec = self.busy.pop(connection)
+        self.idle.append(connection)
+        if not data:
+            raise Exception('Scoring failed in worker process')
+        return vec, array.array('d', data)[0]
+    
+    def map(self, vecs):
+        """ Score a list of state vectors, keeping them in order. """
+        index = { }
+        results = [ None ] * len(vecs)
+        for i, vec in enumerate(vecs):
+            if not self.idle:
+                vec_done, score = self.receive()
+                results[index.pop(id(vec_done))] = score
+            index[id(vec)] = i
+            self.submit(vec)
+        while self.busy:
+            vec_done, score = self.receive()
+            results[index.pop(id(vec_done))] = score
+        return results
+    
+    def close(self, finish=True):
+        """ Shut down the workers and release their cores. 
+        
+            If finish is false, as when an exception is being handled, 
+            workers still scoring are terminated rather than waited for. 
+            Closing again does nothing. """
+        try:
+            while finish and self.busy:
+                self.receive()
+            for connection in self.idle:
+                try:
+                    connection.send_bytes(b'')
+                except OSError:
+                    pass
+            for connection in self.busy:
+                self.process_of[connection].terminate()
+            for process in self.processes:
+                process.join()
+            for connection in self.process_of:
+                connection.close()
+        finally:
+            self.idle = [ ]
+            self.busy = { }
+            self.processes = [ ]
+            self.process_of = { }
+            legion.coordinator().change_cores_used(-self.reserved)
+            self.reserved = 0
+
+
+def score_checked(batch_scorer, checked):
+    """ Score a batch of (vec, constraint score). 
+    
+        Candidates that violate constraints keep their constraint score, 
+        the rest are given to batch_scorer together. 
+        Returns a list of (vec, score). """
+    results = [ ]
+    survivors = [ ]
+    for vec, c_score in checked:
+        if c_score:
+            results.append((vec, (c_score, 0.0)))
+        else:
+            survivors.append(len(results))
+            results.append((vec, None))
+    
+    if survivors:
+        scores = batch_scorer([ results[i][0] for i in survivors ])
+        for i, score in zip(survivors, scores):
+            results[i] = (results[i][0], (0.0, score))
+    
+    return results
+
+
+def score_batch(constrainer, batch_scorer, vecs):
+    """ Score a batch of candidates, as score_checked, 
+        checking them with constrainer first. """
+    return score_checked(batch_scorer, [ (vec, constrainer(vec)) for vec in vecs ])
+
+
+class Candidates:
+    """ The pool of candidates being improved on, in the order they were added.
+    
+        State vectors are the rows of a matrix, and their 
+        (constraint score, score) pairs are kept as two arrays.
+        Scores are also kept in a sorted list, to find the cutoff 
+        without sorting the pool. Statistics of the pool are remembered
+        until it changes.
+    """
+    def __init__(self, items):
+        m = len(items[0][0])
+        self.vecs = numpy.empty((16, m))
+        self.c_scores = numpy.empty(16)
+        self.scores = numpy.empty(16)
+        self.n = 0
+        self.sorted_scores = [ ]
+        self.stats = { }
+        for vec, score in items:
+            self.append(vec, score)
+    
+    def __len__(self):
+        return self.n
+    
+    def append(self, vec, score):
+        if self.n == len(self.scores):
+            size = self.n * 2
+            self.vecs = numpy.resize(self.vecs, (size, self.vecs.shape[1]))
+            self.c_scores = numpy.resize(self.c_scores, size)
+            self.scores = numpy.resize(self.scores, size)
+        self.vecs[self.n] = vec
+        self.c_scores[self.n] = score[0]
+        self.scores[self.n] = score[1]
+        self.n += 1
+        bisect.insort(self.sorted_scores, score[1])
+        self.stats.clear()
+    
+    def matrix(self):
+        return self.vecs[:self.n]
+    
+    def items(self):
+        return [ 
+            (vec, (c_score, score)) 
+            for vec, c_score, score in zip(
+                self.matrix().tolist(), self.c_scores[:self.n].tolist(), self.scores[:self.n].tolist()) 
+            ]
+    
+    def nth_score(self, i):
+        """ i-th smallest score, ignoring constraint scores. """
+        return self.sorted_scores[i]
+    
+    def discard_above(self, cutoff):
+        """ Remove candidates scoring worse than cutoff. """
+        c_scores = self.c_scores[:self.n]
+        scores = self.scores[:self.n]
+        keep = (c_scores < cutoff[0]) | ((c_scores == cutoff[0]) & (scores <= cutoff[1]))
+        if keep.all():
+            return
+        
+        if cutoff[0] == 0.0 and not c_scores[~keep].any():
+            # Only the highest scores are going
+            del self.sorted_scores[bisect.bisect_right(self.sorted_scores, cutoff[1]):]
+        else:
+            self.sorted_scores = sorted(scores[keep].tolist())
+        
+        n = int(keep.sum())
+        self.vecs[:n] = self.vecs[:self.n][keep]
+        self.c_scores[:n] = c_scores[keep]
+        self.scores[:n] = scores[keep]
+        self.n = n
+        self.stats.clear()
+    
+    def rescore(self, scorer):
+        """ Replace the scores of candidates satisfying constraints
+            with scorer(list of vecs). """
+        real = numpy.nonzero(self.c_scores[:self.n] == 0.0)[0]
+        scores = scorer(self.vecs[real].tolist())
+        self.scores[real] = scores
+        self.sorted_scores = sorted(self.scores[:self.n].tolist())
+        self.stats.clear()
+    
+    def best(self):
+        """ Returns (vec, score) of the best candidate. """
+        c_scores = self.c_scores[:self.n]
+        scores = numpy.where(c_scores == c_scores.min(), self.scores[:self.n], numpy.inf)
+        i = int(numpy.argmin(scores))
+        return self.vecs[i].tolist(), (float(c_scores[i]), float(scores[i]))
+    
+    def worst(self):
+        """ Returns the worst (constraint score, score). """
+        if 'worst' not in self.stats:
+            c_scores = self.c_scores[:self.n]
+            c_score = c_scores.max()
+            self.stats['worst'] = (float(c_score), float(self.scores[:self.n][c_scores == c_score].max()))
+        return self.stats['worst']
+    
+    def xspan(self):
+        """ Largest range of any parameter over the pool. """
+        if 'xspan' not in self.stats:
+            matrix = self.matrix()
+            self.stats['xspan'] = float((matrix.max(axis=0) - matrix.min(axis=0)).max())
+        return self.stats['xspan']
+
+
+class Surrogate:
+    """ A cheap model of the score, fitted to recently scored candidates,
+        used to skip scoring candidates confidently predicted 
+        to be worse than the cutoff. 
+        
+        Some candidates that would be skipped are scored anyway, 
+        to check the model. Those that turn out to be better than 
+        the cutoff are false rejections.
+    """
+    def __init__(self, size, refit_interval, validate_fraction=0.1, confidence=2.0, min_residuals=20):
+        self.size = size
+        self.refit_interval = refit_interval
+        self.validate_fraction = validate_fraction
+        self.confidence = confidence
+        self.min_residuals = min_residuals
+        
+        self.vecs = collections.deque(maxlen=size)
+        self.scores = collections.deque(maxlen=size)
+        self.residuals = collections.deque(maxlen=100)
+        self.model = None
+        self.since_fit = 0
+        self.pending = { }
+        
+        self.n_screened = 0
+        self.n_skipped = 0
+        self.n_validated = 0
+        self.n_false = 0
+    
+    def fit(self):
+        import scipy.interpolate
+        
+        vecs = numpy.array(self.vecs)
+        self.since_fit = 0
+        if len(vecs) <= 2*vecs.shape[1]:
+            return
+        
+        self.scale = vecs.std(axis=0) + 1e-12
+        try:
+            self.model = scipy.interpolate.RBFInterpolator(
+                vecs / self.scale, numpy.array(self.scores), 
+                kernel='cubic', degree=1, smoothing=1e-9)
+        except numpy.linalg.LinAlgError:
+            self.model = None
+    
+    def screen(self, vec, cutoff):
+        """ Should scoring vec be skipped? """
+        if self.model is None:
+            return False
+        
+        prediction = float(self.model(numpy.array([ vec ]) / self.scale)[0])
+        self.n_screened += 1
+        skip = False
+        validating = False
+        if len(self.residuals) >= self.min_residuals:
+            margin = self.confidence * math.sqrt(sum( item*item for item in self.residuals ) / len(self.residuals))
+            if prediction - margin > cutoff:
+                if random.random() < self.validate_fraction:
+                    validating = True
+                else:
+                    skip = True
+                    self.n_skipped += 1
+        
+        if not skip:
+            self.pending[tuple(vec)] = (prediction, validating, cutoff)
+        return skip
+    
+    def clear_pending(self):
+        """ Forget predictions of candidates that were not scored, 
+            eg from a batch that was dropped. """
+        self.pending.clear()
+    
+    def add(self, vec, score):
+        """ Learn the score of vec. """
+        key = tuple(vec)
+        if key in self.pending:
+            prediction, validating, cutoff = self.pending.pop(key)
+            self.residuals.append(prediction - score)
+            if validating:
+                self.n_validated += 1
+                if score <= cutoff:
+                    self.n_false += 1
+        
+        self.vecs.append(vec)
+        self.scores.append(score)
+        self.since_fit += 1
+        if self.since_fit >= self.refit_interval:
+            self.fit()
+    
+    def stats(self):
+        """ Counts for telemetry. """
+        return dict(
+            screened = self.n_screened, 
+            skipped = self.n_skipped, 
+            validated = self.n_validated, 
+            false_rejections = self.n_false,
+            )
+    
+    def describe(self):
+        return 'skipped %d of %d (%.0f%%), false rejections %d of %d checked' % (
+            self.n_skipped, self.n_screened, 
+            100.0*self.n_skipped/max(1,self.n_screened),
+            self.n_false, self.n_validated)
 
 
 def make_update(vecs, initial_accuracy, do_noise):
+    """ Mix a new candidate from the rows of the matrix vecs. """
     do_noise = do_noise or random.random() < 0.1
 
     #vecs = random.sample(vecs,min(100,len(vecs)))
     
-    n = len(vecs)
-    m = len(vecs[0])
+    n, m = vecs.shape
     
     #mean = [ 
     #    sum([ vec[i] for vec in vecs ])/n 
@@ -48,10 +390,7 @@ def make_update(vecs, initial_accuracy, do_noise):
     weights = [ weight+offset for weight in weights ]
     weights[ random.randrange(n) ] += 1.0
     
-    update = [ 
-        sum( vecs[j][i]*weights[j] for j in range(n) )
-        for i in range(m) 
-        ]
+    update = numpy.dot(weights, vecs).tolist()
     
     #update = [ 
     #    sum( 
@@ -71,132 +410,791 @@ def make_update(vecs, initial_accuracy, do_noise):
     return update
 
 
+def save_checkpoint(filename, checkpoint):
+    """ Atomically write a checkpoint. """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        pickle.dump(checkpoint, f)
+    os.replace(temp_filename, filename)
+
+def load_checkpoint(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
 def show_status(line):
     print("\r\033[K\r" + line, end="")
     sys.stdout.flush()
 
-def improve(comment, constrainer, scorer, start_x, ftol=1e-4, xtol=1e-6, initial_accuracy=0.001, pool_factor=5, workers=1, monitor = lambda x,y: None):
-    serial = (workers <= 1)
-    if not serial:
-        worker_futs = [ legion.coordinator().new_future() for i in range(workers) ]
-        reply_futs = [ ]
+
+def describe_score(score):
+    """ A (constraint score, score) pair as text. 
+        A candidate not satisfying constraints shows its constraint score, after a C. """
+    if score[0]: return 'C%.6f' % score[0]
+    return '%.6f' % score[1]
+
+
+def start_stage(scorer, workers, batch_scorer=None):
+    """ Start worker processes for scorer if workers > 1.
+        Returns the Worker_pool or None, and batch_scorer 
+        or else a scorer for lists of state vectors. """
+    pool = None
+    if workers > 1:
+        pool = Worker_pool(scorer, workers)
+    
+    if batch_scorer is None:
+        if pool is None:
+            batch_scorer = lambda vecs: [ scorer(vec) for vec in vecs ]
+        else:
+            batch_scorer = pool.map
+    return pool, batch_scorer
+
+
+class Budget:
+    """ When to stop an optimization early: after max_seconds of wall time,
+        after max_evals evaluations, or once the score is target or better 
+        on the final scorer. Each may be None. """
+    def __init__(self, max_seconds=None, max_evals=None, target=None):
+        self.max_seconds = max_seconds
+        self.max_evals = max_evals
+        self.target = target
+        self.start_t = time.time()
+    
+    def check(self, evals, final, best_score):
+        """ Returns why to stop, or None to carry on. 
+            evals is the number of evaluations so far in this run, 
+            final is whether the final scorer is in use. """
+        if self.max_seconds is not None and time.time()-self.start_t >= self.max_seconds:
+            return f"Time budget of {self.max_seconds:g} seconds used up"
+        if self.max_evals is not None and evals >= self.max_evals:
+            return f"Budget of {self.max_evals} evaluations used up"
+        if self.target is not None and final and best_score[0] == 0.0 and best_score[1] <= self.target:
+            return f"Reached target score {self.target:g}"
+        return None
+
+
+class Checker:
+    """ Check candidates against the constraints, 
+        trying to fix any that fail with repairer if it is given. """
+    def __init__(self, constrainer, repairer=None):
+        self.constrainer = constrainer
+        self.repairer = repairer
+        self.n_infeasible = 0
+        self.n_repaired = 0
+    
+    def __call__(self, vec):
+        """ Returns vec, or a repaired version of it, and its constraint score. """
+        c_score = self.constrainer(vec)
+        if c_score and self.repairer:
+            self.n_infeasible += 1
+            repaired = self.repairer(vec)
+            if not self.constrainer(repaired):
+                self.n_repaired += 1
+                return repaired, 0.0
+        return vec, c_score
+
+
+class Migration:
+    """ Swap best candidates with other optimizations every interval 
+        real evaluations. migrate is called with the best candidate 
+        and its score, and returns a list of (vec, score) from elsewhere. 
+        Candidates already sent or received are not taken in again. """
+    def __init__(self, migrate, interval, n_real):
+        self.migrate = migrate
+        self.interval = interval
+        self.next = n_real + interval
+        self.seen = set()
+    
+    def exchange(self, best, best_score, n_real):
+        """ Returns newly received candidates, if it is time to swap. """
+        if n_real < self.next:
+            return [ ]
+        self.next = n_real + self.interval
         
-        workers = [
-            legion.future(worker,scorer,fut)
-            for fut in worker_futs 
-            ]
+        self.seen.add(tuple(best))
+        result = [ ]
+        for vec, score in self.migrate(best, best_score):
+            if tuple(vec) not in self.seen:
+                self.seen.add(tuple(vec))
+                result.append((vec, score))
+        return result
+
+
+class Improve_state:
+    """ The pool of candidates of improve, the best so far, 
+        counts of candidates tried, and the stage of the schedule. 
+        This is what is kept in a checkpoint. """
+    def __init__(self, best, best_score, stage_spread):
+        self.currents = Candidates([ (best, best_score) ])
+        self.best = best
+        self.best_score = best_score
+        self.n = 0
+        self.n_good = 0
+        self.n_real = 0
+        self.n_real_since_best = 0  # A way to at some point give up
+        self.n_constrained = 0
+        self.stage = 0
+        self.stage_n_good = 0
+        self.stage_spread = stage_spread
     
-    last_t = 0.0
-    best = start_x
-    c_score = constrainer(best)
+    def save(self, filename):
+        save_checkpoint(filename, dict(
+            currents = self.currents.items(),
+            best = self.best,
+            best_score = self.best_score,
+            counts = (self.n, self.n_good, self.n_real, self.n_real_since_best),
+            random_state = random.getstate(),
+            stage = self.stage,
+            stage_n_good = self.stage_n_good,
+            stage_spread = self.stage_spread,
+            ))
+    
+    def load(self, filename, last_stage):
+        """ Continue from a checkpoint, if it matches. """
+        saved = load_checkpoint(filename)
+        if 'currents' not in saved or len(saved['best']) != len(self.best):
+            print('Checkpoint does not match, starting from scratch.')
+            return
+        
+        self.currents = Candidates(saved['currents'])
+        self.best = saved['best']
+        self.best_score = saved['best_score']
+        self.n, self.n_good, self.n_real, self.n_real_since_best = saved['counts']
+        random.setstate(saved['random_state'])
+        self.stage = min(saved.get('stage', last_stage), last_stage)
+        self.stage_n_good = saved.get('stage_n_good', 0)
+        self.stage_spread = saved.get('stage_spread', True)
+        print('Resuming from checkpoint, n=%d' % self.n)
+    
+    def add(self, vec, score, pool_size):
+        """ Put a candidate in the pool if it is good enough. 
+            Returns whether it was. """
+        if pool_size < len(self.currents):
+            c = self.currents.nth_score(pool_size)
+        else:
+            c = 1e30
+        cutoff = (self.best_score[0], c)
+        
+        if score > cutoff:
+            return False
+        
+        self.currents.discard_above(cutoff)
+        self.currents.append(vec, score)
+        if score < self.best_score:
+            self.best_score = score
+            self.best = vec
+            self.n_real_since_best = 0
+        return True
+    
+    def converged(self, pool_size, xtol, ftol):
+        """ Has the pool spread out and come back together within xtol, 
+            or stopped improving by more than ftol? """
+        if len(self.currents) < pool_size or self.best_score[0] != 0.0:
+            return False
+        
+        xspan = self.currents.xspan()
+        fspan = self.currents.worst()[1]-self.best_score[1]
+        if xspan >= xtol:
+            self.stage_spread = True
+        return (self.stage_spread and xspan < xtol) or (self.n_good-self.stage_n_good >= 5000 and fspan < ftol)
+    
+    def next_stage(self, batch_scorer, final):
+        """ Move on to the next stage of the schedule, 
+            re-scoring the pool with batch_scorer. """
+        self.stage += 1
+        self.currents.rescore(batch_scorer)
+        self.best, self.best_score = self.currents.best()
+        self.n_real_since_best = 0
+        self.stage_n_good = self.n_good
+        self.stage_spread = final
+
+
+class Progress:
+    """ Status line and telemetry records of improve, every interval seconds. """
+    def __init__(self, comment, telemetry_file, state, interval=20.0):
+        self.comment = comment
+        self.telemetry_file = telemetry_file
+        self.interval = interval
+        self.last_t = 0.0
+        self.last_counts = (time.time(), state.n, state.n_real, state.n_good, state.n_constrained)
+    
+    def due(self):
+        return time.time() > self.last_t+self.interval
+    
+    def record(self, event, state, **items):
+        """ Write a telemetry record, if there is a telemetry file. """
+        if self.telemetry_file:
+            telemetry.write_record(self.telemetry_file, dict(
+                event=event, run=self.comment, stage=state.stage, n=state.n, **items))
+    
+    def report(self, state, screener, check):
+        status = f"Optimizing {self.comment} best={describe_score(state.best_score)} worst={describe_score(state.currents.worst())} pool={len(state.currents)} n_good={state.n_good} n_real={state.n_real} n={state.n}"
+        if screener:
+            status += ' surrogate ' + screener.describe()
+        if check.repairer:
+            status += f" repaired={check.n_repaired}/{check.n_infeasible}"
+        show_status(status)
+        
+        t = time.time()
+        then, last_n, last_n_real, last_n_good, last_n_constrained = self.last_counts
+        tried = max(1, state.n-last_n)
+        self.record('progress', state,
+            n_real = state.n_real,
+            evals_per_second = (state.n_real-last_n_real) / max(1e-9, t-then),
+            acceptance = (state.n_good-last_n_good) / tried,
+            constraint_rejection = (state.n_constrained-last_n_constrained) / tried,
+            pool = len(state.currents),
+            pool_spread = state.currents.xspan() if len(state.currents) > 1 else 0.0,
+            best = state.best_score[1] if state.best_score[0] == 0.0 else None,
+            best_constraint = state.best_score[0],
+            surrogate = screener.stats() if screener else None,
+            )
+        self.last_counts = (t, state.n, state.n_real, state.n_good, state.n_constrained)
+        self.last_t = time.time()
+
+
+def draw_batch(currents, batch, check, screener, screen_cutoff, initial_accuracy, pool_size):
+    """ Make a batch of new candidates for improve, checked against the constraints.
+        If screen_cutoff is given, candidates that the screener is 
+        confident are worse than it are left out.
+        Returns a list of (vec, constraint score), and how many were left out. """
+    vecs = currents.matrix()
+    checked = [ 
+        check(make_update(vecs, initial_accuracy, len(currents) < pool_size)) 
+        for i in range(batch) 
+        ]
+    if screen_cutoff is None:
+        return checked, 0
+    
+    screener.clear_pending()
+    
+    kept = [ item for item in checked if item[1] or not screener.screen(item[0], screen_cutoff) ]
+    return kept, len(checked)-len(kept)
+
+
+def improve(comment, constrainer, scorer, start_x, ftol=1e-4, xtol=1e-6, initial_accuracy=0.001, pool_factor=5, workers=1, monitor = lambda x,y: None, batch=1, batch_scorer=None, checkpoint=None, checkpoint_interval=300.0, resume=False, schedule=[], surrogate=False, repairer=None, migrate=None, migration_interval=2000, max_seconds=None, max_evals=None, target=None, on_stop=None, telemetry_file=None):
+    # If batch > 1, candidates are made and scored batch at a time,
+    # then considered one by one as usual.
+    # batch_scorer takes a list of state vectors and returns a list of scores.
+    # By default it uses scorer, in the pool of worker processes if workers > 1.
+    #
+    # If checkpoint is a filename, the pool, counters and random number 
+    # generator state are saved there every checkpoint_interval seconds.
+    # If resume is also true and the file exists, optimization continues from it.
+    #
+    # schedule is a list of (scorer, xtol) for cheaper, less accurate scorers 
+    # to use first. Each is used until the pool has spread wider than its xtol
+    # and converged back to within it, then the pool is re-scored with the next. 
+    # scorer is used last.
+    #
+    # If surrogate is true, candidates confidently predicted to be worse 
+    # than the cutoff by a Surrogate model are not scored.
+    #
+    # If given, repairer is used to try to fix candidates not satisfying constraints.
+    #
+    # If given, migrate is called with the best candidate and its score 
+    # every migration_interval real evaluations, once on the final scorer.
+    # It returns a list of (vec, score) from elsewhere to add to the pool.
+    #
+    # Optimization also stops after max_seconds of wall time or 
+    # max_evals evaluations in this run, or once the score is 
+    # target or better on the final scorer. Candidates rejected by
+    # the constraints count as evaluations as well as those scored,
+    # so that the budget bounds a run that has yet to satisfy them. The checkpoint is then kept,
+    # so that the optimization can be resumed.
+    # on_stop, if given, is called with a description of why optimization stopped.
+    #
+    # If telemetry_file is given, progress records are appended to it
+    # every 20 seconds, as JSON lines (see telemetry.py).
+    batched = (batch > 1)
+    serial = (workers <= 1)
+    assert not schedule or batch_scorer is None, 'Can not schedule batch_scorer'
+    scorers = [ item[0] for item in schedule ] + [ scorer ]
+    xtols = [ item[1] for item in schedule ] + [ xtol ]
+    given_batch_scorer = batch_scorer
+    
+    c_score = constrainer(start_x)
     if c_score:
         best_score = (c_score, 0.0)
     else:
-        best_score = (0.0, scorer(best))
+        best_score = (0.0, scorers[0](start_x))
+    state = Improve_state(start_x, best_score, not schedule)
     
-    n = 0
-    n_good = 0
-    n_real = 0
-    n_real_since_best = 0  # A way to at some point give up
-    jobs = [ ]
+    pool_size = int(len(start_x)*pool_factor) #5
+    print(len(start_x),'parameters, pool size', pool_size)
     
-    pool_size = int(len(best)*pool_factor) #5
-    print(len(best),'parameters, pool size', pool_size)
-
-    currents = [ (best, best_score) ]
+    if checkpoint and resume and os.path.exists(checkpoint):
+        state.load(checkpoint, len(schedule))
+    last_checkpoint_t = time.time()
+    
+    check = Checker(constrainer, repairer)
+    budget = Budget(max_seconds, max_evals, target)
+    start_n_evals = state.n_real + state.n_constrained
+    migration = Migration(migrate, migration_interval, state.n_real) if migrate else None
+    progress = Progress(comment, telemetry_file, state)
+    progress.record('start', state, parameters=len(start_x), pool_size=pool_size)
     
+    def new_screener():
+        if not surrogate: 
+            return None
+        return Surrogate(4*pool_size, max(10, len(start_x)))
+    screener = new_screener()
+    
+    scorer = scorers[state.stage]
+    pool, batch_scorer = start_stage(scorer, workers, given_batch_scorer)
+    pending = [ ]
+    stopped = None
     done = False
-    while not done or (not serial and reply_futs):
-        t = time.time()
-        if t > last_t+20.0:
-            def rep(x): 
-                if x[0]: return 'C%.6f' % x[0]
-                return '%.6f' % x[1]
-            status = f"Optimizing {comment} best={rep(best_score)} worst={rep(max(item[1] for item in currents))} pool={len(currents)} n_good={n_good} n_real={n_real} n={n}"
-            show_status(status)
+    try:
+        while not done or (not serial and pool.busy):
+            if progress.due():
+                progress.report(state, screener, check)
+                if state.best_score[0] == 0:
+                    monitor(state.best, state.currents.matrix().tolist())
             
-            if best_score[0] == 0:
-                monitor(best, [ item[0] for item in currents ])
-            last_t = time.time()
-        
-        have_score = False
-        
-        if not done and (serial or worker_futs):
-            new = make_update([item[0] for item in currents], initial_accuracy, len(currents) < pool_size)
+            if checkpoint and time.time() > last_checkpoint_t+checkpoint_interval:
+                state.save(checkpoint)
+                last_checkpoint_t = time.time()
             
-            c_score = constrainer(new)
-            if c_score:
-                have_score = True
-                new_score = (c_score, 0.0)
-            elif workers == 1:
+            final = (state.stage == len(schedule))
+            if not done:
+                stopped = budget.check(state.n_real+state.n_constrained-start_n_evals, final, state.best_score)
+                if stopped:
+                    done = True
+                    continue
+                
+                if migration and final and state.best_score[0] == 0.0:
+                    for vec, score in migration.exchange(state.best, state.best_score, state.n_real):
+                        state.add(vec, score, pool_size)
+            
+            # Cutoff for the surrogate to screen candidates against
+            screen_cutoff = None
+            if screener and state.best_score[0] == 0.0 and pool_size < len(state.currents):
+                screen_cutoff = state.currents.nth_score(pool_size)
+            
+            have_score = False
+            if not done and batched:
+                if not pending:
+                    checked, n_skipped = draw_batch(
+                        state.currents, batch, check, screener, screen_cutoff, initial_accuracy, pool_size)
+                    state.n += n_skipped
+                    if not checked:
+                        continue
+                    pending = score_checked(batch_scorer, checked)
+                new, new_score = pending.pop(0)
                 have_score = True
-                new_score = (0.0, scorer(new))
+            
+            elif not done and (serial or pool.idle):
+                new, c_score = check(make_update(state.currents.matrix(), initial_accuracy, len(state.currents) < pool_size))
+                if c_score:
+                    have_score = True
+                    new_score = (c_score, 0.0)
+                elif screen_cutoff is not None and screener.screen(new, screen_cutoff):
+                    state.n += 1
+                    continue
+                elif serial:
+                    have_score = True
+                    new_score = (0.0, scorer(new))
+                else:
+                    pool.submit(new)
+            
+            if not have_score:
+                if not pool.busy or (not done and pool.idle):
+                    continue
+                new, new_score = pool.receive()
+                new_score = (0.0, new_score)
+            
+            state.n += 1
+            if new_score[0] == 0.0:
+                state.n_real += 1
+                state.n_real_since_best += 1
+                if screener:
+                    screener.add(new, new_score[1])
             else:
-                reply_fut = legion.coordinator().new_future()
-                worker_fut = worker_futs.pop(0)                    
-                legion.coordinator().deliver_future(worker_fut, (new, reply_fut))
-                reply_futs.append( (new, reply_fut) )
-        
-        if not have_score:
-            if not reply_futs or (not done and worker_futs):
-                continue
-            new, reply_fut = reply_futs.pop(0)
-            new_score, worker_fut = legion.coordinator().get_future(reply_fut)
-            new_score = (0.0, new_score)
-            worker_futs.append(worker_fut)
-        
-        n += 1
-        if new_score[0] == 0.0:
-            n_real += 1
-            n_real_since_best += 1
-
-        l = sorted( item[1][1] for item in currents )
-        if pool_size < len(l):
-            c = l[pool_size]
-        else:
-            c = 1e30
-        cutoff = (best_score[0], c)
-        
-        if new_score <= cutoff:
-            currents = [ item for item in currents if item[1] <= cutoff ]
-            currents.append((new,new_score))
+                state.n_constrained += 1
             
-            n_good += 1
-        
-            if new_score < best_score:
-                best_score = new_score
-                best = new
-                n_real_since_best = 0
-        
-        if len(currents) >= pool_size and best_score[0] == 0.0:
-            xspan = 0.0
-            for i in range(len(start_x)):
-                xspan = max(xspan,
-                    max(item[0][i] for item in currents) -
-                        min(item[0][i] for item in currents)
-                    )
+            if state.add(new, new_score, pool_size):
+                state.n_good += 1
             
-            fspan = (max(item[1] for item in currents)[1]-best_score[1]) 
+            if state.converged(pool_size, xtols[state.stage], ftol):
+                done = True
             
-            if xspan < xtol or (n_good >= 5000 and fspan < ftol):
+            # Give up if completely stuck
+            if state.n_real_since_best >= 1000000 and not done:
+                show_status('')
+                print("No improvement in 1,000,000 tries.")
                 done = True
+            
+            # Move on to the next scorer, re-scoring the pool with it
+            if done and not stopped and not final:
+                if pool is not None:
+                    pool.close()
+                    pool = None
+                pending = [ ]
+                scorer = scorers[state.stage+1]
+                pool, batch_scorer = start_stage(scorer, workers)
+                state.next_stage(batch_scorer, state.stage+1 == len(schedule))
+                # Surrogate counts are for the stage just finished
+                progress.record('stage', state, best=state.best_score[1], 
+                    surrogate=screener.stats() if screener else None)
+                screener = new_screener()
+                done = False
+                show_status('')
+                print(f"Optimizing {comment} stage {state.stage+1} of {len(scorers)}, best={state.best_score[1]:.5f}")
+    finally:
+        # Also on an exception, so that worker cores are released
+        if pool is not None:
+            pool.close(finish=False)
+    
+    show_status('')
+    print(f"Optimized {comment} best={describe_score(state.best_score)}")
+    if stopped:
+        print(stopped)
+    if screener:
+        print('Surrogate ' + screener.describe())
+    if repairer:
+        print(f"Repaired {check.n_repaired} of {check.n_infeasible} candidates not satisfying constraints")
+    
+    if checkpoint and stopped:
+        state.save(checkpoint)
+    elif checkpoint and os.path.exists(checkpoint):
+        os.unlink(checkpoint)
+    
+    if stopped:
+        reason = stopped
+    elif state.n_real_since_best >= 1000000:
+        reason = 'No improvement in 1,000,000 tries'
+    else:
+        reason = 'Converged'
+    
+    if telemetry_file:
+        telemetry.flush()
+    progress.record('finish', state, n_real=state.n_real, 
+        best=state.best_score[1] if state.best_score[0] == 0.0 else None, 
+        best_constraint=state.best_score[0], reason=reason,
+        surrogate=screener.stats() if screener else None)
+    
+    if on_stop:
+        on_stop(reason)
+    
+    return state.best
+
+
+def cmaes(comment, constrainer, scorer, start_x, ftol=1e-4, xtol=1e-6, initial_accuracy=0.001, workers=1, monitor = lambda x,y: None, batch=1, checkpoint=None, checkpoint_interval=300.0, resume=False, schedule=[], sigma=0.05, max_seconds=None, max_evals=None, target=None, on_stop=None):
+    # CMA-ES, an alternative to improve taking the same arguments.
+    #
+    # Each generation is scored as a batch, of at least batch candidates.
+    # Candidates are ranked first by constraint score, then by score, as in improve,
+    # so candidates that do not satisfy constraints pull the distribution 
+    # toward the feasible region rather than being redrawn.
+    #
+    # Stops when the search distribution is narrower than xtol,
+    # or the best score of each generation has varied by less 
+    # than ftol for a while. A schedule of cheaper scorers is moved through
+    # in the same way as improve, each stage ending when it would have stopped.
+    # Budgets and on_stop are as for improve, checked each generation.
+    n = len(start_x)
+    lam = max(4 + int(3*math.log(n)), batch)
+    mu = lam // 2
+    weights = numpy.log(mu+0.5) - numpy.log(numpy.arange(1,mu+1))
+    weights /= weights.sum()
+    mueff = 1.0 / (weights*weights).sum()
+    cc = (4.0+mueff/n) / (n+4.0+2.0*mueff/n)
+    cs = (mueff+2.0) / (n+mueff+5.0)
+    c1 = 2.0 / ((n+1.3)**2+mueff)
+    cmu = min(1.0-c1, 2.0*(mueff-2.0+1.0/mueff) / ((n+2.0)**2+mueff))
+    damps = 1.0 + 2.0*max(0.0, math.sqrt((mueff-1.0)/(n+1.0))-1.0) + cs
+    chi_n = math.sqrt(n) * (1.0-1.0/(4.0*n)+1.0/(21.0*n*n))
+    history_size = 10 + int(30.0*n/lam)
+    
+    scorers = [ item[0] for item in schedule ] + [ scorer ]
+    xtols = [ item[1] for item in schedule ] + [ xtol ]
+    
+    state = dict(
+        engine = 'cmaes',
+        mean = numpy.array(start_x, dtype=float),
+        sigma = sigma,
+        C = numpy.identity(n),
+        pc = numpy.zeros(n),
+        ps = numpy.zeros(n),
+        generation = 0,
+        best = list(start_x),
+        best_score = (constrainer(start_x), 0.0),
+        counts = (0, 0),
+        history = [ ],
+        stage = 0,
+        rng_state = numpy.random.default_rng(random.getrandbits(64)).bit_generator.state,
+        )
+    
+    if checkpoint and resume and os.path.exists(checkpoint):
+        saved = load_checkpoint(checkpoint)
+        if saved.get('engine') != 'cmaes' or len(saved['best']) != n:
+            print('Checkpoint does not match, starting from scratch.')
+        else:
+            state = saved
+            print('Resuming from checkpoint, n=%d' % state['counts'][0])
+    
+    rng = numpy.random.default_rng()
+    rng.bit_generator.state = state['rng_state']
+    mean = state['mean']
+    sigma = state['sigma']
+    C = state['C']
+    pc = state['pc']
+    ps = state['ps']
+    generation = state['generation']
+    best = state['best']
+    best_score = state['best_score']
+    n_evals, n_real = state['counts']
+    history = state['history']
+    stage = state['stage']
+    
+    print(n,'parameters, population size', lam)
+    
+    def save():
+        save_checkpoint(checkpoint, dict(
+            engine = 'cmaes',
+            mean = mean, sigma = sigma, C = C, pc = pc, ps = ps,
+            generation = generation,
+            best = best, best_score = best_score,
+            counts = (n_evals, n_real),
+            history = history,
+            stage = stage,
+            rng_state = rng.bit_generator.state,
+            ))
+    
+    last_t = 0.0
+    last_checkpoint_t = time.time()
+    budget = Budget(max_seconds, max_evals, target)
+    start_n_evals = n_evals
+    stopped = None
+    
+    done = False
+    while not done:
+        pool, batch_scorer = start_stage(scorers[stage], workers)
+        
+        try:
+            if best_score[0] == 0.0:
+                best_score = (0.0, batch_scorer([ best ])[0])
+            
+            stage_done = False
+            while not stage_done:
+                t = time.time()
+                report = t > last_t+20.0
+                if report:
+                    status = f"Optimizing {comment} best={describe_score(best_score)} sigma={sigma:.2g} generation={generation} n_real={n_real} n={n_evals}"
+                    show_status(status)
+                    last_t = time.time()
+                
+                if checkpoint and t > last_checkpoint_t+checkpoint_interval:
+                    save()
+                    last_checkpoint_t = time.time()
+                
+                stopped = budget.check(n_evals-start_n_evals, stage == len(schedule), best_score)
+                if stopped:
+                    break
+                
+                # Sample a generation
+                eigenvalues, B = numpy.linalg.eigh(C)
+                D = numpy.sqrt(numpy.maximum(eigenvalues, 1e-30))
+                ys = rng.standard_normal((lam,n)) @ (B*D).T
+                vecs = (mean + sigma*ys).tolist()
+                results = score_batch(constrainer, batch_scorer, vecs)
+                n_evals += lam
+                n_real += sum( 1 for item in results if item[1][0] == 0.0 )
+                generation += 1
+                
+                order = sorted(range(lam), key=lambda i: results[i][1])
+                if results[order[0]][1] < best_score:
+                    best, best_score = results[order[0]]
+                
+                if report and best_score[0] == 0.0:
+                    monitor(best, vecs)
+                
+                # Update the distribution
+                y_w = weights @ ys[order[:mu]]
+                mean = mean + sigma*y_w
+                ps = (1.0-cs)*ps + math.sqrt(cs*(2.0-cs)*mueff) * (B @ ((B.T @ y_w) / D))
+                ps_norm = math.sqrt(ps @ ps)
+                h_sigma = ps_norm / math.sqrt(1.0-(1.0-cs)**(2*generation)) / chi_n < 1.4 + 2.0/(n+1.0)
+                pc = (1.0-cc)*pc + h_sigma * math.sqrt(cc*(2.0-cc)*mueff) * y_w
+                y_mu = ys[order[:mu]]
+                C = (
+                    (1.0-c1-cmu) * C 
+                    + c1 * (numpy.outer(pc,pc) + (not h_sigma)*cc*(2.0-cc)*C)
+                    + cmu * (y_mu.T * weights) @ y_mu
+                    )
+                C = (C + C.T) * 0.5
+                sigma *= math.exp((cs/damps) * (ps_norm/chi_n - 1.0))
+                
+                if results[order[0]][1][0] == 0.0:
+                    history = (history + [ results[order[0]][1][1] ])[-history_size:]
+                else:
+                    history = [ ]
+                
+                if sigma * math.sqrt(C.diagonal().max()) < xtols[stage]:
+                    stage_done = True
+                if len(history) == history_size and max(history)-min(history) < ftol:
+                    stage_done = True
+        finally:
+            if pool is not None:
+                pool.close(finish=False)
         
-        # Give up if completely stuck
-        if n_real_since_best >= 1000000:
+        if stopped:
+            done = True
+        elif stage < len(schedule):
+            stage += 1
+            history = [ ]
             show_status('')
-            print("No improvement in 1,000,000 tries.")
+            print(f"Optimizing {comment} stage {stage+1} of {len(scorers)}")
+        else:
             done = True
     
     show_status('')
-    print(f"Optimized {comment} best={best_score[1]:.5f}")
+    print(f"Optimized {comment} best={describe_score(best_score)}")
+    if stopped:
+        print(stopped)
+    
+    if checkpoint and stopped:
+        save()
+    elif checkpoint and os.path.exists(checkpoint):
+        os.unlink(checkpoint)
+    
+    if on_stop:
+        on_stop(stopped or 'Converged')
+    
+    return best
+
+
+def least_squares(comment, residuals, start_x, lower=None, xtol=1e-8, ftol=1e-12, max_iterations=100, diff_step=1e-6):
+    # Levenberg-Marquardt fit of x to minimize the sum of squares 
+    # of residuals(x), a list of numbers. 
+    # For small, smooth problems, where improve would be slow.
+    #
+    # The Jacobian is estimated by forward differences, 
+    # with steps of diff_step relative to each parameter.
+    # If lower is given, parameters are kept at or above it.
+    # Stops when a step changes x by less than xtol (relative)
+    # or the sum of squares by less than ftol (relative).
+    x = numpy.array(start_x, dtype=float)
+    if lower is not None:
+        lower = numpy.asarray(lower, dtype=float)
+        x = numpy.maximum(x, lower)
+    r = numpy.array(residuals(x.tolist()), dtype=float)
+    cost = r @ r
+    damping = 1e-3
+    n_evals = 1
+    
+    for iteration in range(max_iterations):
+        show_status(f"Fitting {comment} rms={math.sqrt(cost/max(1,len(r))):.6f} iteration={iteration} n={n_evals}")
         
-    if not serial:
-        while worker_futs:
-            fut = worker_futs.pop(0)
-            legion.coordinator().deliver_future(fut, None)
+        J = numpy.empty((len(r), len(x)))
+        for j in range(len(x)):
+            step = diff_step * max(1.0, abs(x[j]))
+            x_step = x.copy()
+            x_step[j] += step
+            J[:,j] = (numpy.array(residuals(x_step.tolist()), dtype=float) - r) / step
+        n_evals += len(x)
         
-        for item in workers:
-            item()
+        A = J.T @ J
+        g = J.T @ r
+        scale = numpy.maximum(A.diagonal(), 1e-12)
+        
+        # Increase damping until a step reduces the sum of squares
+        while True:
+            delta = numpy.linalg.solve(A + damping*numpy.diag(scale), -g)
+            x_new = x + delta
+            if lower is not None:
+                x_new = numpy.maximum(x_new, lower)
+            r_new = numpy.array(residuals(x_new.tolist()), dtype=float)
+            n_evals += 1
+            cost_new = r_new @ r_new
+            if cost_new < cost or damping > 1e10:
+                break
+            damping *= 10.0
+        
+        if cost_new >= cost:
+            break
+        
+        converged = (
+            numpy.all(abs(x_new-x) <= xtol*(abs(x)+xtol)) or 
+            cost-cost_new <= ftol*cost
+            )
+        x, r, cost = x_new, r_new, cost_new
+        damping = max(damping*0.1, 1e-12)
+        if converged:
+            break
+    
+    show_status('')
+    print(f"Fitted {comment} rms={math.sqrt(cost/max(1,len(r))):.6f} in {n_evals} evaluations")
+    return x.tolist()
+
+
+def _island(board, island, comment, constrainer, scorer, start_x, monitor, checkpoint, kwargs):
+    """ Run improve as one island, exchanging migrants through 
+        the legion coordinator. Returns (best, best_score, reason stopped). """
+    random.seed()
+    
+    def migrate(best, best_score):
+        coordinator = legion.coordinator()
+        coordinator.post_migrant(board, island, (best, best_score))
+        return [ value for key, value in coordinator.get_migrants(board).items() if key != island ]
+    
+    # Only the island currently in the lead reports its progress
+    def island_monitor(best, others):
+        if monitor is None:
+            return
+        posted = legion.coordinator().get_migrants(board)
+        if not posted or min(posted, key=lambda key: posted[key][1]) == island:
+            monitor(best, others)
     
+    if checkpoint:
+        root, ext = os.path.splitext(checkpoint)
+        checkpoint = '%s-island%d%s' % (root, island+1, ext)
+    
+    reasons = [ ]
+    try:
+        best = improve('%s island %d' % (comment, island+1), constrainer, scorer, start_x, 
+            monitor=island_monitor, checkpoint=checkpoint, migrate=migrate, on_stop=reasons.append, **kwargs)
+    finally:
+        # Finish any snapshot this island's copy of the monitor is writing,
+        # so it can not overwrite the final design
+        if hasattr(monitor, 'close'):
+            monitor.close()
+    
+    c_score = constrainer(best)
+    if c_score:
+        return best, (c_score, 0.0), reasons[0]
+    return best, (0.0, scorer(best)), reasons[0]
+
+
+def islands(comment, constrainer, scorer, start_x, islands=4, monitor=None, checkpoint=None, on_stop=None, **kwargs):
+    # Island model: several independent improve pools, each in its own 
+    # legion process, so spread over other hosts if legion is set up to. 
+    # Islands swap their best candidates every migration_interval 
+    # real evaluations, and the best of all of them is returned.
+    #
+    # Other arguments are as for improve, 
+    # and must be picklable to be sent to the islands.
+    board = '%s_%d_%f' % (comment, os.getpid(), time.time())
+    
+    with legion.Stage() as stage:
+        futures = [ 
+            stage.process(_island, board, i, comment, constrainer, scorer, start_x, monitor, checkpoint, kwargs)
+            for i in range(islands) 
+            ]
+    results = [ future() for future in futures ]
+    legion.coordinator().clear_migrants(board)
+    
+    best, best_score, reason = min(results, key=lambda item: item[1])
+    print(f"Optimized {comment} on {islands} islands, best={describe_score(best_score)}")
+    if on_stop:
+        on_stop(reason)
     return best
+
+
+# Optimization engines, by name
+engines = dict(
+    improve = improve,
+    cmaes = cmaes,
+    )
         
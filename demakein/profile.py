@@ -1,5 +1,5 @@
 
-import bisect, math
+import bisect, math, functools
 from .raphs_curves import cornu
 
 
@@ -139,28 +139,39 @@ def cornu_yx(t,mirror):
     if mirror: y = -y
     return y,x
 
-def solve(a1,a2):        
+def solve_errors(a1,a2,t1,t2,mirror):
+    """ Angle errors of the Cornu spiral section t1..t2 as a curve
+        leaving its chord at angle a1 and arriving at angle a2,
+        or None if the section is unusable. """
     pi = math.pi
     two_pi = pi*2
     
-    def score(t1,t2,mirror):
-        if abs(t1-t2) < 1e-6 or max(abs(t1),abs(t2)) > pi*10.0: return 1e30
-    
-        y1,x1 = cornu_yx(t1, mirror)
-        y2,x2 = cornu_yx(t2, mirror)
-        chord_a = math.atan2(y2-y1,x2-x1)
-        chord_l = length(y2-y1, x2-x1)
-        this_a1 = abs(t1) #t1*t1
-        this_a2 = abs(t2) #t2*t2
-        if mirror:
-            this_a1 = -this_a1
-            this_a2 = -this_a2
-        if t1 > t2:
-            this_a1 += pi
-            this_a2 += pi
-        ea1 = (this_a1-chord_a-a1+pi)%two_pi - pi
-        ea2 = (this_a2-chord_a-a2+pi)%two_pi - pi
-        return ea1*ea1+ea2*ea2
+    if abs(t1-t2) < 1e-6 or max(abs(t1),abs(t2)) > pi*10.0: return None
+
+    y1,x1 = cornu_yx(t1, mirror)
+    y2,x2 = cornu_yx(t2, mirror)
+    chord_a = math.atan2(y2-y1,x2-x1)
+    this_a1 = abs(t1) #t1*t1
+    this_a2 = abs(t2) #t2*t2
+    if mirror:
+        this_a1 = -this_a1
+        this_a2 = -this_a2
+    if t1 > t2:
+        this_a1 += pi
+        this_a2 += pi
+    ea1 = (this_a1-chord_a-a1+pi)%two_pi - pi
+    ea2 = (this_a2-chord_a-a2+pi)%two_pi - pi
+    return ea1, ea2
+
+def solve_score(a1,a2,t1,t2,mirror):
+    errors = solve_errors(a1,a2,t1,t2,mirror)
+    if errors is None: return 1e30
+    ea1, ea2 = errors
+    return ea1*ea1+ea2*ea2
+
+def solve_search(a1,a2):
+    """ Coarse grid search followed by pattern search. """
+    pi = math.pi
     
     s = None
     n = 2
@@ -169,7 +180,7 @@ def solve(a1,a2):
             for j in range(-n,n+1):    
                 new_t1 = i*pi/n
                 new_t2 = j*pi/n
-                new_s = score(new_t1,new_t2,new_mirror)
+                new_s = solve_score(a1,a2,new_t1,new_t2,new_mirror)
                 if s is None or new_s < s:
                     t1 = new_t1
                     t2 = new_t2
@@ -179,7 +190,7 @@ def solve(a1,a2):
     step = pi / n * 0.5
     while step >= 1e-4:
         for new_t1,new_t2 in [(t1+step,t2+step), (t1-step,t2-step), (t1-step,t2+step), (t1+step,t2-step)]:
-            new_s = score(new_t1,new_t2,mirror)
+            new_s = solve_score(a1,a2,new_t1,new_t2,mirror)
             if new_s < s:
                 s = new_s
                 t1 = new_t1
@@ -190,6 +201,87 @@ def solve(a1,a2):
 
     return t1, t2, mirror
 
+def solve_newton(a1,a2,t1,t2,mirror, iterations=8, h=1e-7):
+    """ Polish a nearby solution with Newton's method. 
+        Returns t1,t2,mirror,score or None if this fails. """
+    for i in range(iterations):
+        errors = solve_errors(a1,a2,t1,t2,mirror)
+        if errors is None: return None
+        ea1, ea2 = errors
+        if ea1*ea1+ea2*ea2 < 1e-24: break
+        
+        errors1 = solve_errors(a1,a2,t1+h,t2,mirror)
+        errors2 = solve_errors(a1,a2,t1,t2+h,mirror)
+        if errors1 is None or errors2 is None: return None
+        j11 = (errors1[0]-ea1)/h
+        j21 = (errors1[1]-ea2)/h
+        j12 = (errors2[0]-ea1)/h
+        j22 = (errors2[1]-ea2)/h
+        det = j11*j22-j12*j21
+        if abs(det) < 1e-12: return None
+        t1 -= (j22*ea1-j12*ea2)/det
+        t2 -= (j11*ea2-j21*ea1)/det
+    
+    return t1, t2, mirror, solve_score(a1,a2,t1,t2,mirror)
+
+
+# Angles are rounded to this before solving, so that solutions can be remembered
+SOLVE_QUANTUM = 1e-9
+
+# Spacing of the table of solutions used as starting points
+SOLVE_TABLE_STEP = math.pi/32
+
+# Warm started solutions worse than this are solved from scratch
+SOLVE_TOLERANCE = 1e-12
+
+@functools.lru_cache(maxsize=None)
+def solve_table(i,j):
+    """ Solution at table node (i*SOLVE_TABLE_STEP, j*SOLVE_TABLE_STEP),
+        filled in as needed. """
+    return solve_search(i*SOLVE_TABLE_STEP, j*SOLVE_TABLE_STEP)
+
+@functools.lru_cache(maxsize=4096)
+def solve_quantized(q1,q2):
+    a1 = q1*SOLVE_QUANTUM
+    a2 = q2*SOLVE_QUANTUM
+    
+    limit = math.pi/SOLVE_TABLE_STEP
+    u = a1/SOLVE_TABLE_STEP
+    v = a2/SOLVE_TABLE_STEP
+    if abs(u) < limit and abs(v) < limit:
+        i = int(math.floor(u))
+        j = int(math.floor(v))
+        corners = [ solve_table(i+di,j+dj) for di in (0,1) for dj in (0,1) ]
+        
+        # Interpolate between corners if they are all on the same branch,
+        # otherwise start from whichever corner fits best
+        starts = list(corners)
+        if len(set( item[2] for item in corners )) == 1 and \
+               max( abs(item[0]-corners[0][0])+abs(item[1]-corners[0][1]) for item in corners ) < 1.0:
+            fu = u-i
+            fv = v-j
+            weights = [ (1-fu)*(1-fv), (1-fu)*fv, fu*(1-fv), fu*fv ]
+            starts.insert(0, (
+                sum( w*item[0] for w,item in zip(weights,corners) ),
+                sum( w*item[1] for w,item in zip(weights,corners) ),
+                corners[0][2],
+            ))
+        
+        for start in starts:
+            result = solve_newton(a1,a2,*start)
+            if result is not None and result[3] <= SOLVE_TOLERANCE:
+                return result[:3]
+    
+    return solve_search(a1,a2)
+
+def solve(a1,a2):
+    """ Find a section t1..t2 of the (possibly mirrored) Cornu spiral 
+        that leaves its chord at angle a1 and arrives at angle a2.
+        
+        Solutions are polished from a table of solutions, 
+        and recent results are remembered. """
+    return solve_quantized(int(round(a1/SOLVE_QUANTUM)), int(round(a2/SOLVE_QUANTUM)))
+
 def curved_profile(pos, low, high, low_angle, high_angle, quality=512):
     n = len(pos)
 
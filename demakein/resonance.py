@@ -0,0 +1,496 @@
+"""
+
+Array-backed version of the phase calculation in design.Instrument.
+
+The chain of closures built by Instrument.prepare_phase is compiled
+into arrays of pipe lengths, junction area ratios and hole parameters.
+The chain is then evaluated for a whole batch of wavelengths and
+fingerings at once, with the batch as the array dimension.
+
+Results are the same as Instrument.resonance_phase, to within
+floating point rounding.
+
+"""
+
+import math
+
+import numpy
+
+STEP = 1
+HOLE = 2
+
+
+class Phase_chain:
+    """ Compiled phase chain of an instrument.
+
+        Elements are enumerated from the bottom (open end) upward.
+        Each element is a length of pipe followed by either
+        a step in the bore, a hole, or nothing (the top of the instrument).
+        A conical length of pipe has a non-zero taper at either end 
+        (see Instrument.conical_bore).
+        
+        All fingerings are stepped through the chain together, 
+        so the cost of a call is mostly per element rather than per fingering. 
+        Sharing the common lower part of the chain between fingerings 
+        would only help for fingerings probed at the same wavelength, 
+        which the designers do not do.
+    """
+
+    def __init__(self, inst, stepped=False):
+        """ Compile inst's phase elements, 
+            with the bore stepped if stepped is true (see Instrument.phase_elements). """
+        lengths = [ ]
+        kinds = [ ]
+        ratios = [ ]
+        hole_indexes = [ ]
+        hole_ratios = [ ]
+        open_lengths = [ ]
+        closed_lengths = [ ]
+        taper_lows = [ ]
+        taper_highs = [ ]
+        hole_areas = numpy.zeros(len(inst.hole_diameters))
+
+        for length, action, junction, taper in inst.phase_elements(stepped):
+            lengths.append(length)
+            if taper is None:
+                taper_lows.append(0.0)
+                taper_highs.append(0.0)
+            else:
+                taper_lows.append(taper[0])
+                taper_highs.append(taper[1])
+            if action == 'step':
+                area, area1 = junction
+                kinds.append(STEP)
+                ratios.append(area1/area)
+                hole_indexes.append(-1)
+                hole_ratios.append(0.0)
+                open_lengths.append(0.0)
+                closed_lengths.append(0.0)
+            elif action == 'hole':
+                area, hole_area, open_length, closed_length, index = junction
+                kinds.append(HOLE)
+                ratios.append(area/area)
+                hole_indexes.append(index)
+                hole_ratios.append(hole_area/area)
+                hole_areas[index] = hole_area
+                open_lengths.append(open_length)
+                closed_lengths.append(closed_length)
+            else:
+                kinds.append(0)
+                ratios.append(1.0)
+                hole_indexes.append(-1)
+                hole_ratios.append(0.0)
+                open_lengths.append(0.0)
+                closed_lengths.append(0.0)
+
+        self.n_holes = len(inst.hole_diameters)
+        self.closed_top = inst.closed_top
+        
+        # For emission, as per Instrument.prepare
+        self.hole_areas = hole_areas
+        stepped_inner = inst.stepped_bore()[0]
+        bottom_diameter = stepped_inner(0.0, True)
+        top_diameter = stepped_inner(inst.length)
+        self.bottom_area = math.pi*0.25*bottom_diameter*bottom_diameter
+        self.top_area = math.pi*0.25*top_diameter*top_diameter
+
+        self.lengths = numpy.array(lengths, dtype=float)
+        self.kinds = numpy.array(kinds, dtype=int)
+        self.ratios = numpy.array(ratios, dtype=float)
+        self.hole_indexes = numpy.array(hole_indexes, dtype=int)
+        self.hole_ratios = numpy.array(hole_ratios, dtype=float)
+        self.open_lengths = numpy.array(open_lengths, dtype=float)
+        self.closed_lengths = numpy.array(closed_lengths, dtype=float)
+        self.taper_lows = numpy.array(taper_lows, dtype=float)
+        self.taper_highs = numpy.array(taper_highs, dtype=float)
+
+        # Plain lists are faster to step through element by element
+        self._elements = list(zip(
+            self.lengths.tolist(), self.kinds.tolist(), self.ratios.tolist(),
+            self.hole_indexes.tolist(), self.hole_ratios.tolist(),
+            self.open_lengths.tolist(), self.closed_lengths.tolist(),
+            self.taper_lows.tolist(), self.taper_highs.tolist(),
+            ))
+
+    def __len__(self):
+        return len(self._elements)
+
+    def phase(self, w, fingers, derivative=False):
+        """ Batched equivalent of Instrument.resonance_phase.
+
+            w       - array of wavelengths, first dimension enumerates fingerings
+            fingers - array of 0/1 hole states, shape (len(w), n_holes)
+
+            Returns an array of phases the same shape as w.
+            If derivative is true, also returns the derivative 
+            of phase with respect to wavelength.
+        """
+        w = numpy.asarray(w, dtype=float)
+        fingers = numpy.asarray(fingers, dtype=bool).reshape((w.shape[0], self.n_holes))
+        # Broadcast each hole's state over any trailing dimensions of w
+        closed = fingers.reshape(fingers.shape + (1,)*(w.ndim-1))
+
+        two_on_w = 2.0 / w
+        w_on_two_pi = w / (2.0*numpy.pi)
+        phase = numpy.full(w.shape, 0.5) #Open end
+        if derivative:
+            two_on_w2 = -two_on_w / w
+            grad = numpy.zeros(w.shape)
+
+        for length, kind, ratio, index, hole_ratio, open_length, closed_length, taper_low, taper_high in self._elements:
+            # In a cone, tan(pi*phase) less 1/(k*r) transforms as in a cylinder
+            if taper_low:
+                shift = numpy.floor(phase + 0.5)
+                tan = numpy.tan(numpy.pi * (phase - shift))
+                y = tan - taper_low * w_on_two_pi
+                phase = numpy.arctan(y) / numpy.pi + shift
+                if derivative:
+                    grad = ((1.0 + tan*tan) * grad - taper_low / (2.0*numpy.pi*numpy.pi)) / (1.0 + y*y)
+            
+            phase += length * two_on_w
+            if derivative:
+                grad += length * two_on_w2
+            
+            if taper_high:
+                shift = numpy.floor(phase + 0.5)
+                tan = numpy.tan(numpy.pi * (phase - shift))
+                y = tan + taper_high * w_on_two_pi
+                phase = numpy.arctan(y) / numpy.pi + shift
+                if derivative:
+                    grad = ((1.0 + tan*tan) * grad + taper_high / (2.0*numpy.pi*numpy.pi)) / (1.0 + y*y)
+
+            if kind == STEP:
+                shift = numpy.floor(phase + 0.5)
+                tan = numpy.tan(numpy.pi * (phase - shift))
+                y = ratio * tan
+                phase = numpy.arctan(y) / numpy.pi + shift
+                if derivative:
+                    grad *= ratio * (1.0 + tan*tan) / (1.0 + y*y)
+
+            elif kind == HOLE:
+                hole_closed = closed[:,index]
+                hole_phase = numpy.where(
+                    hole_closed,
+                    closed_length * two_on_w,
+                    open_length * two_on_w - 0.5
+                    )
+                shift1 = numpy.floor(phase + 0.5)
+                shift2 = numpy.floor(hole_phase + 0.5)
+                tan1 = numpy.tan(numpy.pi * (phase - shift1))
+                tan2 = numpy.tan(numpy.pi * (hole_phase - shift2))
+                y = ratio * tan1 + hole_ratio * tan2
+                phase = numpy.arctan(y) / numpy.pi + shift1 + shift2
+                if derivative:
+                    hole_grad = numpy.where(hole_closed, closed_length, open_length) * two_on_w2
+                    grad = (
+                        ratio * (1.0 + tan1*tan1) * grad + 
+                        hole_ratio * (1.0 + tan2*tan2) * hole_grad
+                        ) / (1.0 + y*y)
+
+        if not self.closed_top:
+            phase += 0.5
+
+        if derivative:
+            return phase, grad
+        return phase
+
+
+    def emission(self, w, fingers):
+        """ Batched equivalent of the emission from Instrument.resonance_score,
+            using the complex reply through the same chain.
+            
+            w       - for each fingering, a wavelength
+            fingers - array of 0/1 hole states, shape (len(w), n_holes)
+            
+            Returns, for each fingering, a list of the emission from 
+            the bottom end then from each open hole, relative to the top area.
+            There are no cones in the complex model, so this should be called 
+            on a chain of a stepped bore (see Instrument.emissions).
+        """
+        w = numpy.asarray(w, dtype=float)
+        fingers = numpy.asarray(fingers, dtype=bool).reshape((len(w), self.n_holes))
+        four_pi_on_w = 4.0*numpy.pi / w
+        
+        reply = numpy.full(len(w), -1.0+0.0j) #Open end
+        emission = numpy.zeros((len(w), 1+self.n_holes))
+        emission[:,0] = self.bottom_area
+        emitting = numpy.zeros((len(w), 1+self.n_holes), dtype=bool)
+        emitting[:,0] = True
+        column = 1
+        
+        for length, kind, ratio, index, hole_ratio, open_length, closed_length, _, _ in self._elements:
+            reply = reply * numpy.exp(1j * length * four_pi_on_w)
+            
+            if kind == STEP:
+                pjunc = 2.0 / (1.0 - ratio*((reply-1.0)/(reply+1.0)))
+                emission *= abs(pjunc/(reply+1.0))[:,None]
+                reply = pjunc - 1.0
+            
+            elif kind == HOLE:
+                hole_open = ~fingers[:,index]
+                hole_reply = numpy.where(
+                    hole_open,
+                    -numpy.exp(1j * open_length * four_pi_on_w),
+                    numpy.exp(1j * closed_length * four_pi_on_w),
+                    )
+                pjunc = 2.0 / (
+                    1.0 - ratio*((reply-1.0)/(reply+1.0)) 
+                    - hole_ratio*((hole_reply-1.0)/(hole_reply+1.0))
+                    )
+                emission *= abs(pjunc/(reply+1.0))[:,None]
+                emission[:,column] = self.hole_areas[index] * abs(pjunc/(hole_reply+1.0))
+                emitting[:,column] = hole_open
+                column += 1
+                reply = pjunc - 1.0
+        
+        emission /= self.top_area
+        return [ row[mask].tolist() for row, mask in zip(emission, emitting) ]
+
+
+    def true_wavelengths_near(self, w, fingers, n=None, refine_steps=8, xtol=1e-10, step_cents=1.0):
+        """ Batched equivalent of Instrument.true_wavelength_near 
+            and Instrument.true_nth_wavelength_near.
+            
+            w       - for each fingering, wavelength to look for a resonance near
+            fingers - array of 0/1 hole states, shape (len(w), n_holes)
+            n       - None, or for each fingering None or 
+                      the number of the resonance to look for
+            step_cents - size of the first probe step
+            
+            Roots are bracketed exactly as the probe-by-probe walk would 
+            bracket them, for all fingerings together. Rather than linearly 
+            interpolating, brackets are then refined by safeguarded 
+            Newton iteration using the derivative of phase.
+        """
+        w = numpy.asarray(w, dtype=float)
+        fingers = numpy.asarray(fingers, dtype=bool).reshape((len(w), self.n_holes))
+        if n is None:
+            n = [ None ] * len(w)
+        
+        wrapped = numpy.array([ item is None for item in n ], dtype=bool)
+        nth = numpy.array([ 0.0 if item is None else item for item in n ], dtype=float)
+        
+        x1 = numpy.empty(len(w))
+        y1 = numpy.empty(len(w))
+        x2 = numpy.empty(len(w))
+        y2 = numpy.empty(len(w))
+        target = numpy.empty(len(w))
+        bracketed = numpy.empty(len(w), dtype=bool)
+        for which, bracketer in [ 
+                (wrapped, lambda: self._bracket_wrapped(w[wrapped], fingers[wrapped], step_cents)),
+                (~wrapped, lambda: self._bracket_nth(w[~wrapped], fingers[~wrapped], nth[~wrapped], step_cents)),
+                ]:
+            if which.any():
+                x1[which], y1[which], x2[which], y2[which], target[which], bracketed[which] = bracketer()
+        
+        # As per the probe-by-probe walk
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            m = (y2-y1)/(x2-x1)
+            c = y1-m*x1
+            result = numpy.where(x1 == x2, x1, -c/m)
+        
+        # Safeguarded Newton, maintaining phase(low) >= target > phase(high)
+        rows = numpy.nonzero(bracketed)[0]
+        low = x1[rows]
+        high = x2[rows]
+        for i in range(refine_steps):
+            if not len(rows): break
+            x = result[rows]
+            phase, grad = self.phase(x, fingers[rows], derivative=True)
+            error = phase - target[rows]
+            
+            above = error >= 0
+            low = numpy.where(above, x, low)
+            high = numpy.where(above, high, x)
+            
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                new = x - error/grad
+            outside = ~((new > low) & (new < high))
+            new[outside] = 0.5*(low[outside]+high[outside])
+            result[rows] = new
+            
+            unconverged = abs(new-x) > xtol*x
+            rows = rows[unconverged]
+            low = low[unconverged]
+            high = high[unconverged]
+        
+        return result
+    
+    
+    def _bracket_wrapped(self, w, fingers, step_cents = 1.0, step_increase = 1.05, max_steps = 100):
+        """ Brackets chosen by Instrument.true_wavelength_near.
+        
+            The probes it walks outward through do not depend on the
+            scores, so they are evaluated ahead of need, a chunk of 
+            levels at a time. 
+        """
+        m = len(w)
+        step = pow(2.0, step_cents/1200.0)
+        half_step = math.sqrt(step)
+        
+        lows = numpy.empty((m, max_steps+1))
+        highs = numpy.empty((m, max_steps+1))
+        lows[:,0] = w/half_step
+        highs[:,0] = w*half_step
+        for i in range(max_steps):
+            lows[:,i+1] = lows[:,i]/step
+            highs[:,i+1] = highs[:,i]*step
+            step **= step_increase
+        
+        low_phases = numpy.zeros((m, max_steps+1))
+        high_phases = numpy.zeros((m, max_steps+1))
+        
+        choice = numpy.full(m, -1)
+        done = 0
+        levels = 4
+        while True:
+            todo = numpy.nonzero(choice < 0)[0]
+            if not len(todo): break
+            
+            probes = numpy.concatenate([ lows[todo,done:levels+1], highs[todo,done:levels+1] ], axis=1)
+            phases = self.phase(probes, fingers[todo])
+            low_phases[todo,done:levels+1] = phases[:,:levels+1-done]
+            high_phases[todo,done:levels+1] = phases[:,levels+1-done:]
+            done = levels+1
+            
+            low_scores = (low_phases[todo,:done]+0.5)%1.0-0.5
+            high_scores = (high_phases[todo,:done]+0.5)%1.0-0.5
+            
+            # Pairs in the order they are checked: 
+            # each iteration checks the two highest probes, then the two lowest
+            high_check = numpy.empty((len(todo), done-1), dtype=bool)
+            high_check[:,0] = (low_scores[:,0] >= 0) & (high_scores[:,0] < 0)
+            high_check[:,1:] = (high_scores[:,:-2] >= 0) & (high_scores[:,1:-1] < 0)
+            low_check = (low_scores[:,1:] >= 0) & (low_scores[:,:-1] < 0)
+            checks = numpy.empty((len(todo), 2*(done-1)), dtype=bool)
+            checks[:,0::2] = high_check
+            checks[:,1::2] = low_check
+            
+            found = checks.any(axis=1)
+            choice[todo[found]] = numpy.argmax(checks[found], axis=1)
+            
+            if levels >= max_steps:
+                choice[todo[~found]] = 2*max_steps
+                break
+            levels = min(max_steps, levels*4)
+        
+        rows = numpy.arange(m)
+        iteration = choice // 2
+        is_low = choice % 2 == 1
+        is_centre = choice == 0
+        failed = choice == 2*max_steps
+        
+        # Index of the higher probe of each pair, in the lows or highs
+        index2 = numpy.where(is_low, iteration, numpy.where(is_centre, 0, iteration))
+        index1 = numpy.where(is_low, iteration+1, numpy.where(is_centre, 0, iteration-1))
+        index1[failed] = index2[failed] = 0
+        x1 = numpy.where(is_low | is_centre, lows[rows,index1], highs[rows,index1])
+        p1 = numpy.where(is_low | is_centre, low_phases[rows,index1], high_phases[rows,index1])
+        x2 = numpy.where(is_low, lows[rows,index2], highs[rows,index2])
+        p2 = numpy.where(is_low, low_phases[rows,index2], high_phases[rows,index2])
+        
+        # No bracket found, use whichever extreme probe is closest to resonating
+        closest = numpy.where(
+            abs((high_phases[rows,-1]+0.5)%1.0-0.5) < abs((low_phases[rows,-1]+0.5)%1.0-0.5),
+            highs[rows,-1], 
+            lows[rows,-1]
+            )
+        x1[failed] = x2[failed] = closest[failed]
+        
+        target = numpy.floor(p1+0.5)
+        
+        # A wrap-around of phase rather than a resonance can also look like
+        # a bracket, only true brackets can be refined
+        bracketed = ~failed & (numpy.floor(p2+0.5) == target)
+        return x1, p1-target, x2, p2-numpy.floor(p2+0.5), target, bracketed
+    
+    
+    def _bracket_nth(self, w, fingers, n, step_cents = 1.0, step_increase = 1.5, max_steps = 20):
+        """ Brackets chosen by Instrument.true_nth_wavelength_near.
+        
+            Each end of the walk is extended on successive iterations 
+            until its score changes sign, after which it never moves again.
+            So the probes at each end are known in advance, and are evaluated 
+            ahead of need a chunk at a time. The walk itself is then replayed 
+            for all fingerings together.
+        """
+        m = len(w)
+        step = pow(2.0, step_cents/1200.0)
+        half_step = math.sqrt(step)
+        
+        lows = numpy.empty((m, max_steps+1))
+        highs = numpy.empty((m, max_steps+1))
+        lows[:,0] = w/half_step
+        highs[:,0] = w*half_step
+        for i in range(max_steps):
+            lows[:,i+1] = lows[:,i]/step
+            highs[:,i+1] = highs[:,i]*step
+            step **= step_increase
+        
+        low_scores = numpy.zeros((m, max_steps+1))
+        high_scores = numpy.zeros((m, max_steps+1))
+        
+        x1 = numpy.empty(m)
+        y1 = numpy.empty(m)
+        x2 = numpy.empty(m)
+        y2 = numpy.empty(m)
+        active = numpy.ones(m, dtype=bool)
+        rows = numpy.arange(m)
+        
+        # Index of the lowest and highest probe so far
+        low_i = numpy.zeros(m, dtype=int)
+        high_i = numpy.zeros(m, dtype=int)
+        
+        done = 0
+        def need(level):
+            nonlocal done
+            if level < done: return
+            new_done = min(max_steps+1, max(level+1, done*4))
+            todo = numpy.nonzero(active)[0]
+            probes = numpy.concatenate([ lows[todo,done:new_done], highs[todo,done:new_done] ], axis=1)
+            scores = self.phase(probes, fingers[todo]) - n[todo,None]
+            low_scores[todo,done:new_done] = scores[:,:new_done-done]
+            high_scores[todo,done:new_done] = scores[:,new_done-done:]
+            done = new_done
+        
+        def probe(which):
+            """ Lowest (0), next lowest (1), highest (-1) or 
+                next highest (-2) probe of each walk so far. """
+            if which == 0:
+                return lows[rows,low_i], low_scores[rows,low_i]
+            if which == 1:
+                x = numpy.where(low_i > 0, lows[rows,low_i-1], highs[:,0])
+                y = numpy.where(low_i > 0, low_scores[rows,low_i-1], high_scores[:,0])
+                return x, y
+            if which == -1:
+                return highs[rows,high_i], high_scores[rows,high_i]
+            x = numpy.where(high_i > 0, highs[rows,high_i-1], lows[:,0])
+            y = numpy.where(high_i > 0, high_scores[rows,high_i-1], low_scores[:,0])
+            return x, y
+        
+        def check(a, b):
+            (a_x, a_y), (b_x, b_y) = a, b
+            which = active & (a_y >= 0) & (b_y < 0)
+            x1[which] = a_x[which]
+            y1[which] = a_y[which]
+            x2[which] = b_x[which]
+            y2[which] = b_y[which]
+            active[which] = False
+        
+        need(4)
+        for iteration in range(max_steps):
+            check(probe(-2), probe(-1))
+            if not active.any(): break
+            
+            need(iteration+1)
+            low_i += active & (low_scores[rows,low_i] <= 0)
+            check(probe(0), probe(1))
+            high_i += active & (high_scores[rows,high_i] >= 0)
+        
+        # No bracket found, use whichever extreme probe is closest to resonating
+        (low_x, low_y), (high_x, high_y) = probe(0), probe(-1)
+        closest = numpy.where(abs(high_y) < abs(low_y), high_x, low_x)
+        x1[active] = x2[active] = closest[active]
+        y1[active] = y2[active] = 0.0
+        
+        return x1, y1, x2, y2, n, ~active
@@ -0,0 +1,98 @@
+"""
+
+Design a family of variants of an instrument, such as a set of sizes.
+
+Each variant starts optimizing from the finished design of its nearest 
+neighbour in the list, since a scaled design is a good starting point.
+
+"""
+
+import shlex, time
+
+import demakein
+from . import config, legion, design
+
+
+def find_designer(name):
+    for item in vars(demakein).values():
+        if isinstance(item, type) and \
+               issubclass(item, design.Instrument_designer) and \
+               item.shell_name() == name:
+            return item
+    raise config.Error('No designer called ' + name)
+
+
+def _run_variant(action):
+    start = time.time()
+    action.make()
+    return time.time() - start
+
+
+@config.help("""\
+Design several variants of an instrument, \
+each starting from the design of its nearest finished neighbour.
+""","""\
+Each variant is given as a quoted set of flags for the designer, \
+for example "--transpose 5". \
+The first variant is designed first, then the rest in batches \
+of up to --make-cores at a time. \
+A summary of scores and times is written to summary.txt.
+""")
+@config.Positional('designer', 'Designer to use, eg design-folk-flute.')
+@config.Main_section('variants', 'Flags for each variant.')
+class Sweep(config.Action_with_output_dir):
+    designer = None
+    variants = [ ]
+    
+    def _variant_dir(self, i):
+        name = self.variants[i].replace('--','').strip() or 'default'
+        return self.get_workspace() / ('%d-%s' % (i, config.filesystem_friendly_name(name)))
+    
+    def run(self):
+        assert self.designer, 'Designer required'
+        assert self.variants, 'No variants given'
+        designer_class = find_designer(self.designer)
+        
+        n = len(self.variants)
+        cores = max(1, legion.coordinator().get_cores())
+        
+        # The first variant on its own, then batches in list order
+        batches = [ [0] ] + [ 
+            list(range(i, min(n,i+cores))) 
+            for i in range(1,n,cores) 
+            ]
+        
+        seeds = [ None ] * n
+        times = [ None ] * n
+        finished = [ ]
+        for batch in batches:
+            futures = [ ]
+            with legion.Stage() as stage:
+                for i in batch:
+                    action = designer_class(self._variant_dir(i))
+                    action.parse(shlex.split(self.variants[i]))
+                    if finished:
+                        seeds[i] = min(finished, key=lambda j: (abs(i-j),j))
+                        action = action(initial_from=self._variant_dir(seeds[i]))
+                    futures.append(stage.process(_run_variant, action))
+            
+            for i, future in zip(batch, futures):
+                times[i] = future()
+            finished.extend(batch)
+        
+        lines = [ '%-30s %-30s %12s %12s' % ('variant', 'started from', 'score', 'time (s)') ]
+        for i in range(n):
+            result = design.load(self._variant_dir(i))
+            lines.append('%-30s %-30s %12.5f %12.1f' % (
+                self.variants[i],
+                self.variants[seeds[i]] if seeds[i] is not None else '-',
+                result._scorer(result.state_vec),
+                times[i],
+                ))
+        
+        with open(self.get_workspace()/'summary.txt', 'w') as f:
+            for line in lines:
+                print(line, file=f)
+        print()
+        for line in lines:
+            print(line)
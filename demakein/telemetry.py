@@ -0,0 +1,221 @@
+"""
+
+Telemetry from optimization, as a JSON-lines file.
+
+optimize.improve writes a record of its progress every 20 seconds.
+Designers time the phases of a sample of evaluations,
+in whichever process does the evaluating,
+and write histograms of these times from time to time.
+
+"""
+
+import os, time, json, math, collections
+
+from . import config
+
+
+def write_record(filename, record):
+    """ Append a record to a telemetry file.
+        Each record is written in a single call, so records from
+        several processes do not get mixed up. """
+    record = dict(record, time=time.time())
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_records(filename):
+    with open(filename) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+
+def _bucket(seconds):
+    """ Histogram bucket of a time, in powers of two of microseconds. """
+    return max(0, int(math.log2(max(seconds*1e6, 1.0))))
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+class _Not_timed:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NOT_TIMED = _Not_timed()
+
+
+class Phase_timer:
+    """ Time the phases of one in every so many evaluations.
+
+        Histograms of times are written to the telemetry file
+        every interval seconds. """
+    def __init__(self, filename, every=16, interval=20.0):
+        self.filename = filename
+        self.every = every
+        self.interval = interval
+        self.count = 0
+        self.sampling = False
+        self.phases = { }
+        self.last_write = time.time()
+
+    def start(self):
+        """ Start an evaluation, deciding whether to time it. """
+        self.count += 1
+        self.sampling = (self.count % self.every == 0)
+
+    def add(self, name, seconds):
+        if name not in self.phases:
+            self.phases[name] = dict(n=0, total=0.0, histogram=collections.Counter())
+        phase = self.phases[name]
+        phase['n'] += 1
+        phase['total'] += seconds
+        phase['histogram'][_bucket(seconds)] += 1
+
+    def finish(self):
+        self.sampling = False
+        if time.time() > self.last_write + self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.phases:
+            write_record(self.filename, dict(
+                event = 'timing',
+                pid = os.getpid(),
+                evaluations = self.count,
+                phases = self.phases,
+                ))
+        self.phases = { }
+        self.count = 0
+        self.last_write = time.time()
+
+
+# Phase_timers of this process, by filename
+_TIMERS = { }
+_current = None
+
+def timer(filename):
+    """ Phase_timer for a telemetry file, for this process,
+        which will be used by phase(...). """
+    global _current
+    key = (filename, os.getpid())
+    if key not in _TIMERS:
+        _TIMERS[key] = Phase_timer(filename)
+    _current = _TIMERS[key]
+    return _current
+
+def phase(name):
+    """ Context manager timing a phase of an evaluation,
+        if this evaluation is being timed. """
+    if _current is None or not _current.sampling:
+        return _NOT_TIMED
+    return _Phase(_current, name)
+
+def flush():
+    """ Write out times so far from all Phase_timers of this process. """
+    for (filename, pid), item in _TIMERS.items():
+        if pid == os.getpid():
+            item.flush()
+
+
+def _percentile(histogram, fraction):
+    """ Approximate percentile, in seconds, from a histogram. """
+    total = sum(histogram.values())
+    count = 0
+    for bucket in sorted(histogram):
+        count += histogram[bucket]
+        if count >= fraction*total:
+            return 2.0**(bucket+1) * 1e-6
+    return 0.0
+
+
+@config.help("""\
+Summarize the telemetry.jsonl file written while designing an instrument.
+""","""\
+Shows the rate of evaluation, how many candidates were accepted or \
+did not satisfy constraints, the spread of the pool, how the best score \
+improved, how many candidates the surrogate model skipped and \
+wrongly rejected, and where the time in each evaluation went.
+""")
+@config.Positional('working_dir', 'Output directory of a designer.')
+class Telemetry_summary(config.Action):
+    working_dir = None
+
+    def run(self):
+        filename = os.path.join(self.working_dir, 'telemetry.jsonl')
+        if not os.path.exists(filename):
+            raise config.Error('No telemetry in ' + self.working_dir)
+        records = read_records(filename)
+
+        runs = collections.OrderedDict()
+        for record in records:
+            if 'run' in record:
+                runs.setdefault(record['run'], [ ]).append(record)
+
+        for name, items in runs.items():
+            print(name)
+            start = items[0]['time']
+            print('%10s %8s %10s %8s %8s %10s %12s %12s' % (
+                'seconds', 'stage', 'evals/s', 'accept', 'constr', 'pool', 'spread', 'best'))
+            for item in items:
+                if item['event'] != 'progress': continue
+                print('%10.0f %8d %10.1f %7.1f%% %7.1f%% %10d %12.3g %12s' % (
+                    item['time'] - start, item['stage']+1, item['evals_per_second'],
+                    item['acceptance']*100, item['constraint_rejection']*100,
+                    item['pool'], item['pool_spread'],
+                    '%.5f' % item['best'] if item['best'] is not None else '-',
+                    ))
+            for item in items:
+                surrogate = item.get('surrogate')
+                if item['event'] in ('stage','finish') and surrogate:
+                    print('Surrogate in stage %d: skipped %d of %d screened (%.0f%%), false rejections %d of %d checked' % (
+                        item['stage']+1 if item['event'] == 'finish' else item['stage'],
+                        surrogate['skipped'], surrogate['screened'],
+                        100.0*surrogate['skipped']/max(1,surrogate['screened']),
+                        surrogate['false_rejections'], surrogate['validated']))
+            for item in items:
+                if item['event'] == 'finish':
+                    if item['best'] is None:
+                        best = 'not satisfying constraints, C%.5f' % item['best_constraint']
+                    else:
+                        best = '%.5f' % item['best']
+                    print('Finished after %.0f seconds, %d evaluations, best %s: %s' % (
+                        item['time'] - start, item['n_real'], best, item['reason']))
+            print()
+
+        phases = collections.OrderedDict()
+        evaluations = 0
+        for record in records:
+            if record['event'] != 'timing': continue
+            evaluations += record['evaluations']
+            for name, item in record['phases'].items():
+                if name not in phases:
+                    phases[name] = dict(n=0, total=0.0, histogram=collections.Counter())
+                phases[name]['n'] += item['n']
+                phases[name]['total'] += item['total']
+                for bucket, count in item['histogram'].items():
+                    phases[name]['histogram'][int(bucket)] += count
+
+        if phases:
+            whole = phases.get('evaluation', dict(total=0.0))['total']
+            print('Time per evaluation, from %d timed of %d evaluations:' % (
+                max(item['n'] for item in phases.values()), evaluations))
+            print('%-16s %10s %10s %10s %8s' % ('phase', 'mean ms', 'median ms', '90% ms', 'share'))
+            for name, item in phases.items():
+                print('%-16s %10.3f %10.3f %10.3f %7.1f%%' % (
+                    name, item['total']/item['n']*1000,
+                    _percentile(item['histogram'], 0.5)*1000,
+                    _percentile(item['histogram'], 0.9)*1000,
+                    item['total']/whole*100 if whole else 0.0,
+                    ))
+            print('(unpack includes curved_profile, histogram buckets are powers of 2)')
@@ -0,0 +1,152 @@
+"""
+
+Monte Carlo analysis of how manufacturing tolerances affect the tuning
+of a finished design.
+
+Each sample perturbs the hole diameters, hole positions and bore diameter
+of the design by random amounts within the tolerances,
+and finds the resonance of every fingering.
+
+"""
+
+import copy, math
+
+import numpy
+
+from . import config, legion, design
+
+
+def _perturbed_instrument(designer, base, diameters, positions, dilation):
+    inst = copy.copy(base)
+    inst.hole_diameters = [ a+b for a,b in zip(base.hole_diameters, diameters) ]
+    inst.hole_positions = [ a+b for a,b in zip(base.hole_positions, positions) ]
+    inst.inner = base.inner + dilation
+    designer._hole_geometry(inst)
+    return designer.patch_instrument(inst)
+
+
+def _resonances(designer, inst, ws, ns):
+    inst.prepare_phase_array()
+    return inst.true_wavelengths_near(
+        ws, [ item[1] for item in designer.fingerings ], ns,
+        step_cents=designer.probe_cents)
+
+
+def _samples(designer, ws, ns, tolerances, n_samples, seed):
+    """ Returns a matrix of perturbations, one row per sample,
+        and a matrix of the cents each note moved by. """
+    base = designer.unpack(designer.state_vec)
+    n_holes = designer.n_holes
+    rng = numpy.random.default_rng(seed)
+
+    diameter, position, dilate = tolerances
+    perturbations = numpy.hstack([
+        rng.uniform(-diameter, diameter, (n_samples, n_holes)),
+        rng.uniform(-position, position, (n_samples, n_holes)),
+        rng.uniform(-dilate, dilate, (n_samples, 1)),
+        ])
+
+    cents = numpy.empty((n_samples, len(ws)))
+    s = 1200.0/math.log(2)
+    for i, row in enumerate(perturbations):
+        inst = _perturbed_instrument(
+            designer, base, row[:n_holes], row[n_holes:2*n_holes], row[-1])
+        cents[i] = (numpy.log(ws) - numpy.log(_resonances(designer, inst, ws, ns))) * s
+    return perturbations, cents
+
+
+@config.help("""\
+Estimate how manufacturing tolerances move the notes of a finished design.
+""","""\
+Instruments are sampled with each hole diameter, each hole position \
+and the bore diameter (as for --dilate when making) \
+varied uniformly within plus or minus the given tolerances. \
+Samples are spread over --make-cores processes. \
+The distribution of how many cents each note moves, \
+and a ranking of which dimensions matter most, \
+are written to tolerance.txt in the working directory.
+""")
+@config.Int_flag('samples', 'Number of instruments to sample.')
+@config.Float_flag('diameter', 'Tolerance of hole diameters, in mm.')
+@config.Float_flag('position', 'Tolerance of hole positions, in mm.')
+@config.Float_flag('dilate', 'Tolerance of bore diameter, in mm.')
+@config.Int_flag('seed', 'Random number seed.')
+class Tolerance(config.Action_with_working_dir):
+    samples = 2000
+    diameter = 0.1
+    position = 0.1
+    dilate = 0.1
+    seed = 1
+
+    def run(self):
+        designer = design.load(self.working_dir)
+        n_holes = designer.n_holes
+
+        # Resonances of the design as it is.
+        # Samples are searched for from these, so search again from 
+        # the first result to land where an unperturbed sample would
+        ns = [ item[2] if len(item) >= 3 else None for item in designer.fingerings ]
+        inst = designer.patch_instrument(designer.unpack(designer.state_vec))
+        ws = [ design.wavelength(item[0], designer.transpose) for item in designer.fingerings ]
+        for i in range(2):
+            ws = _resonances(designer, inst, ws, ns)
+
+        tolerances = (self.diameter, self.position, self.dilate)
+        cores = max(1, legion.coordinator().get_cores())
+        sizes = [ self.samples//cores + (i < self.samples%cores) for i in range(cores) ]
+        with legion.Stage() as stage:
+            futures = [
+                stage.process(_samples, designer, ws, ns, tolerances, size, [ self.seed, i ])
+                for i, size in enumerate(sizes) if size
+                ]
+        results = [ future() for future in futures ]
+        perturbations = numpy.vstack([ item[0] for item in results ])
+        cents = numpy.vstack([ item[1] for item in results ])
+
+        lines = [
+            '%d samples, hole diameters +/-%gmm, hole positions +/-%gmm, bore diameter +/-%gmm'
+                % (len(cents), self.diameter, self.position, self.dilate),
+            '',
+            'Cents each note moves, sharp is positive:',
+            '%-6s %-16s %8s %8s %8s %8s %8s' % ('note', 'fingers', 'mean', 'sd', '5%', '95%', 'worst'),
+            ]
+        for i, item in enumerate(designer.fingerings):
+            column = cents[:,i]
+            low, high = numpy.percentile(column, [5,95])
+            lines.append('%-6s %-16s %8.2f %8.2f %8.2f %8.2f %8.2f' % (
+                item[0], ''.join(str(int(finger)) for finger in item[1]),
+                column.mean(), column.std(), low, high, column[numpy.argmax(abs(column))],
+                ))
+
+        # Sensitivity of each note to each dimension, from a linear fit,
+        # ranked by the spread in cents over notes it causes
+        names = (
+            [ 'hole %d diameter' % (i+1) for i in range(n_holes) ] +
+            [ 'hole %d position' % (i+1) for i in range(n_holes) ] +
+            [ 'bore diameter' ]
+            )
+        X = numpy.hstack([ numpy.ones((len(perturbations),1)), perturbations ])
+        slopes = numpy.linalg.lstsq(X, cents - cents.mean(axis=0), rcond=None)[0][1:]
+        # Standard deviation of a uniform distribution
+        spreads = numpy.array([ self.diameter ]*n_holes + [ self.position ]*n_holes + [ self.dilate ]) / math.sqrt(3)
+        effects = abs(slopes) * spreads[:,None]
+        rms_effects = numpy.sqrt((effects*effects).mean(axis=1))
+
+        lines.extend([
+            '',
+            'Sensitivity, bottom hole first:',
+            '%-18s %12s %12s  %s' % ('dimension', 'rms sd', 'worst sd', 'worst note'),
+            ])
+        for j in numpy.argsort(-rms_effects):
+            worst = numpy.argmax(effects[j])
+            lines.append('%-18s %12.3f %12.3f  %s (%+.1f cents/mm)' % (
+                names[j], rms_effects[j], effects[j,worst],
+                designer.fingerings[worst][0], slopes[j,worst],
+                ))
+
+        with open(self.get_workspace()/'tolerance.txt', 'w') as f:
+            for line in lines:
+                print(line, file=f)
+        print()
+        for line in lines:
+            print(line)
@@ -1,5 +1,5 @@
 
-import math
+import math, copy, pickle
 
 from . import config, design, optimize
 
@@ -28,33 +28,34 @@ class Tune(config.Action_with_working_dir):
     tweak = None
     observations = [ ]
     
-    def _constraint_score(self, state):
-        #All positive
-        return sum( max(-item,0.0) for item in state )
+    def _instrument(self, mod):
+        if self.working.base is None:
+            instrument = mod.unpack(self.working.designer.state_vec)
+        else:
+            # patch_instrument may alter lists in place, such as hole_lengths
+            instrument = copy.copy(self.working.base)
+            for name, value in vars(instrument).items():
+                if isinstance(value, list):
+                    setattr(instrument, name, list(value))
+        return mod.patch_instrument(instrument)
     
     def _errors(self, state):
         mod = self.working.designer(
             **dict(list(zip(self.working.parameters,state)))
             )
         
-        instrument = mod.patch_instrument(
-            mod.unpack(self.working.designer.state_vec)
-            )
-        instrument.prepare_phase()
+        instrument = self._instrument(mod)
+        instrument.prepare_phase_array()
         
-        errors = [ ]
+        ws_obtained = [ item[0] for item in self.working.observations ]
+        ws_expected = instrument.true_wavelengths_near(
+            ws_obtained, [ item[1] for item in self.working.observations ])
         
         s = 1200.0/math.log(2)
-        for item in self.observations:
-            parts = item.split(',')
-            assert len(parts) == (mod.n_holes+1)
-            fingers = [ int(item2) for item2 in parts[1:] ]
-            w_obtained = design.SPEED_OF_SOUND / float(parts[0])
-            w_expected = instrument.true_wavelength_near(w_obtained, fingers)
-
-            errors.append( (math.log(w_obtained)-math.log(w_expected))*s )
-    
-        return errors
+        return [ 
+            (math.log(w_obtained)-math.log(w_expected))*s 
+            for w_obtained, w_expected in zip(ws_obtained, ws_expected) 
+            ]
     
     def _score(self, state):
         errors = self._errors(state)
@@ -97,17 +98,34 @@ class Tune(config.Action_with_working_dir):
             getattr(self.working.designer,item)
             for item in self.working.parameters
             ]
+        
+        self.working.observations = [ ]
+        for item in self.observations:
+            parts = item.split(',')
+            assert len(parts) == (self.working.designer.n_holes+1)
+            fingers = [ int(item2) for item2 in parts[1:] ]
+            self.working.observations.append(
+                (design.SPEED_OF_SOUND / float(parts[0]), fingers))
+        
+        # If the parameters being tweaked only affect patch_instrument,
+        # as mouthpiece parameters do, the unpacked instrument can be reused.
+        state_vec = self.working.designer.state_vec
+        self.working.base = self.working.designer.unpack(state_vec)
+        for name, value in zip(self.working.parameters, initial):
+            mod = self.working.designer(**{ name: value*1.01+0.01 })
+            if pickle.dumps(mod.unpack(state_vec)) != pickle.dumps(self.working.base):
+                self.working.base = None
+                break
 
         print('Current model and errors:')        
         self._report(initial)
         
-        if self.parameters:
-            state = optimize.improve(
+        if self.working.parameters:
+            state = optimize.least_squares(
                 self.shell_name(), 
-                self._constraint_score, 
-                self._score, 
+                self._errors, 
                 initial,
-                #monitor=self._report
+                lower=[ 0.0 ] * len(initial), #All positive
                 )
             
             print('Optimized model and errors:')
@@ -92,6 +92,49 @@ demakein make-mouthpiece: output/mouthpiece
 #demakein make-reed-shaper: output/reed-shaper
 
 
+# Optimization budgets, which must stop a run
+# even before it satisfies the constraints
+
+demakein design-folk-whistle: output/folk-whistle-budget --max-evals 200
+demakein design-folk-whistle: output/folk-whistle-budget --optimizer cmaes --max-evals 200
+
+
+# Designer options, with short budgets
+
+demakein design-folk-whistle: output/folk-whistle-options --batch 8 --surrogate yes --repair-candidates yes --multi-fidelity yes --max-seconds 60
+demakein design-folk-whistle: output/folk-whistle-options --batch 8 --surrogate yes --repair-candidates yes --multi-fidelity yes --max-seconds 60 --resume yes
+demakein design-folk-whistle: output/folk-whistle-islands --islands 2 --max-seconds 60
+demakein design-folk-whistle: output/folk-whistle-cmaes --optimizer cmaes --max-seconds 60
+demakein design-folk-whistle: output/folk-whistle-from --initial-from output/folk-whistle --max-seconds 60
+demakein design-three-hole-whistle: output/three-hole-whistle-conical --conical yes --max-seconds 60
+
+# Shared design cache, the second design should come from the cache
+
+rm -rf output/cache
+DEMAKEIN_CACHE=output/cache demakein design-reed-drone: output/drone-cached --cache yes
+DEMAKEIN_CACHE=output/cache demakein design-reed-drone: output/drone-cached2 --cache yes
+grep -q "Using cached design" output/drone-cached2/stop_reason.txt
+
+
+# Utilities
+
+demakein telemetry-summary: output/folk-whistle
+demakein tolerance: output/folk-whistle --samples 200
+# With no perturbation, no note should move
+demakein tolerance: output/folk-whistle --samples 20 --diameter 0 --position 0 --dilate 0
+python -c "
+lines = open('output/folk-whistle/tolerance.txt').read().split('\n')
+rows = lines[lines.index('')+3:]
+rows = rows[:rows.index('')]
+assert rows and all( abs(float(row.split()[2])) < 0.005 and abs(float(row.split()[6])) < 0.005 for row in rows ), rows
+"
+demakein tune: output/folk-whistle tweak-gapextra,tweak-boreless 587,1,1,1,1,1,1 659,0,1,1,1,1,1 740,0,0,1,1,1,1 784,0,0,0,1,1,1
+demakein sweep: output/sweep design-folk-whistle "--max-seconds 30" "--transpose 2 --max-seconds 30"
+demakein compare-optimizers: output/compare-optimizers --max-evals 2000 design-folk-whistle
+demakein bench: output/bench --seconds 0.2 --max-evals 2000 design-folk-whistle
+demakein bench: output/bench-again --seconds 0.2 --converge no --baseline output/bench/bench.json design-folk-whistle
+
+
 # Omnibus collection
 
 demakein all: output/all